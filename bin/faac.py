@@ -16,16 +16,39 @@ Last Modification: 27/May/2021
 
 from datetime import datetime, timedelta
 from sys import exit
-from IPy import IP
+from IPy import IP, IPv4ranges, IPv6ranges
+import numpy as np
 import re
 import os
+import gzip
+import bz2
+import lzma
+import mmap
+import zlib
+import json
+import hashlib
 import yaml
 import glob
 import shutil
 import multiprocessing as mp
 from math import floor
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from contextlib import contextmanager
 from sys import stdin
-#import subprocess
+
+# Optional compression formats
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+import subprocess
+from collections import deque, OrderedDict
 #import time
 
 #-----------------------------------------------------------------------
@@ -192,19 +215,16 @@ class IpVariable(Variable):
         
     def load(self, raw_value):
         """Converts an input raw value into a IP address.
-        Returns: IP object, if the conversion succeeds;
+        Returns: IPAddress object, if the conversion succeeds;
                  None, if the conversion fails.
 
         raw_value -- The input raw value, representing a IP address
                      (eg. '192.168.1.1').
         """
         try:
-            ipaddr = IP(raw_value)
-        except:
-            ipaddr = None
-            print('\033[33m'+ "Error while processing IP: '%s'" %(raw_value) +'\033[m')           
-            
-        return ipaddr
+            return parseIp(raw_value)
+        except TypeError:           # unhashable raw value, not cached
+            return parseIp.__wrapped__(raw_value)
 
 
 class TimeVariable(Variable):
@@ -222,7 +242,7 @@ class TimeVariable(Variable):
                  None, if the conversion fails.
         """
         try:
-            timestamp = datetime.strptime(raw_value, tsformat)
+            timestamp = parseTimestamp(raw_value, tsformat)
         except:
             print('\033[31m'+ "Error while comparing %s with %s" %(raw_value, tsformat) +'\033[m')
             timestamp = None
@@ -230,7 +250,7 @@ class TimeVariable(Variable):
         # If no year is defined in log_timestamp, current year is set
         try:
             if timestamp.year == 1900:
-                timestamp = timestamp.replace(year = datetime.now().year)
+                timestamp = timestamp.replace(year = CURRENT_YEAR)
         except AttributeError:
             pass
             
@@ -320,6 +340,280 @@ class MultipleVariable(object):
         return self.value.__str__()
 
 
+#-----------------------------------------------------------------------
+# Timestamp parsing
+#-----------------------------------------------------------------------
+
+# Year set to the timestamps without year (computed once per run)
+CURRENT_YEAR = datetime.now().year
+
+TIME_CACHE_SIZE = 4096      # distinct minutes kept by parseMinute
+
+
+def isoParser(sep, fraction):
+    """Returns a parser for timestamps like '2016-12-02 18:32:01' (sep ' ') or
+    '2016-12-02T18:32:01' (sep 'T'), followed by '.%f' microseconds if fraction
+    is True. Parsers raise ValueError for values they do not accept, so they
+    are always checked against datetime.strptime.
+    """
+    def parse(raw_value):
+        if len(raw_value) < 19 or raw_value[4] != '-' or raw_value[7] != '-' or raw_value[10] != sep or \
+           raw_value[13] != ':' or raw_value[16] != ':':
+            raise ValueError(raw_value)
+        digits = raw_value[0:4] + raw_value[5:7] + raw_value[8:10] + raw_value[11:13] + raw_value[14:16] + raw_value[17:19]
+        if not (digits.isascii() and digits.isdigit()):
+            raise ValueError(raw_value)
+        microsecond = 0
+        if fraction:
+            digits = raw_value[20:]
+            if raw_value[19:20] != '.' or not 0 < len(digits) <= 6 or not (digits.isascii() and digits.isdigit()):
+                raise ValueError(raw_value)
+            microsecond = int(digits.ljust(6, '0'))
+        elif len(raw_value) != 19:
+            raise ValueError(raw_value)
+        return datetime(int(raw_value[0:4]), int(raw_value[5:7]), int(raw_value[8:10]),
+                        int(raw_value[11:13]), int(raw_value[14:16]), int(raw_value[17:19]), microsecond)
+    return parse
+
+
+def parseEpoch(raw_value):
+    """Parser for epoch timestamps in seconds (eg. '1480703521' or '1480703521.250'),
+    converted to local time.
+    """
+    try:
+        return datetime.fromtimestamp(float(raw_value))
+    except (OverflowError, OSError):
+        raise ValueError(raw_value)
+
+
+# Specialised parsers for the common timestamp formats
+TIME_PARSERS = {'%Y-%m-%d %H:%M:%S': isoParser(' ', False), '%Y-%m-%dT%H:%M:%S': isoParser('T', False),
+                '%Y-%m-%d %H:%M:%S.%f': isoParser(' ', True), '%Y-%m-%dT%H:%M:%S.%f': isoParser('T', True),
+                '%s': parseEpoch}
+
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def parseMinute(head, tsformat):
+    """Parses the timestamp of a minute: a raw timestamp cut before the seconds,
+    for a format ending in ':%S'.
+    """
+    return datetime.strptime(head + ':00', tsformat)
+
+
+def parseTimestamp(raw_value, tsformat):
+    """Converts a raw timestamp into a datetime object, as datetime.strptime does
+    (raising ValueError or TypeError if the conversion fails). The year is not set.
+
+    The common formats (see TIME_PARSERS) are parsed by specialised parsers. For
+    any other format ending in ':%S' (eg. '%m/%d-%H:%M:%S'), the part before the
+    seconds is parsed once per minute and cached, so logs with many entries per
+    minute are parsed almost for free. Values the fast paths do not accept are
+    left to datetime.strptime.
+
+    raw_value -- the raw value in string format (eg. '2014-12-20 15:01:02')
+    tsformat  -- timestamp format
+    """
+    if isinstance(raw_value, datetime):        # already decoded from binary data
+        return raw_value
+
+    parser = TIME_PARSERS.get(tsformat)
+    if parser is not None:
+        try:
+            return parser(raw_value)
+        except (ValueError, TypeError):
+            pass
+    elif isinstance(raw_value, str) and tsformat.endswith(':%S') and not re.search('%[SXcTs]', tsformat[:-3]):
+        head, sep, second = raw_value.rpartition(':')
+        if sep and len(second) == 2 and second.isascii() and second.isdigit():
+            try:
+                return parseMinute(head, tsformat).replace(second = int(second))
+            except ValueError:
+                pass
+
+    return datetime.strptime(raw_value, tsformat)
+
+
+#-----------------------------------------------------------------------
+# Time sampling
+#-----------------------------------------------------------------------
+
+EPOCH = datetime(1970, 1, 1)    # timestamps are naive, so are their epoch seconds
+
+
+def windowId(timestamp, window):
+    """Returns the id of the sampling window of a timestamp: the number of
+    windows elapsed since the epoch. Ids are the internal keys of the
+    observations and are only formatted (with windowTag) at output time.
+
+    timestamp -- Datetime object.
+    window    -- Sampling window length, in minutes.
+    """
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) // int(window * 60)
+
+
+def windowTag(window_id, window):
+    """Returns the output tag of a sampling window (eg. '201612021830'),
+    i.e. its start time formatted as %Y%m%d%H%M.
+
+    window_id -- Window id, as returned by windowId.
+    window    -- Sampling window length, in minutes.
+    """
+    return (EPOCH + timedelta(seconds = window_id * int(window * 60))).strftime("%Y%m%d%H%M")
+
+
+#-----------------------------------------------------------------------
+# IPAddress Class
+#-----------------------------------------------------------------------
+
+class IPAddress(object):
+    """IP address (or network) backed by integers.
+
+    Replaces IPy.IP objects as the value of IP variables. Addresses compare,
+    hash and print like IPy.IP objects, and iptype() returns the same types,
+    but they are resolved with integer operations only.
+
+    Class Attributes:
+        version   -- IP version (4 or 6).
+        ip        -- Address (first address of the network) as an integer.
+        prefixlen -- Prefix length (32 or 128 for single addresses).
+        text      -- String representation, as printed by IPy.
+    """
+    __slots__ = ('version', 'ip', 'prefixlen', 'text', 'type')
+
+    def __init__(self, version, ip, prefixlen, text):
+        self.version = version
+        self.ip = ip
+        self.prefixlen = prefixlen
+        self.text = text
+        self.type = None
+
+    def iptype(self):
+        """Returns the type of the IP address ('PRIVATE', 'PUBLIC', 'LOOPBACK'...),
+        as IPy.IP.iptype() does.
+        """
+        if self.type is None:
+            boundaries, types = IP_RANGES[self.version]
+            self.type = types[bisect_right(boundaries, self.ip) - 1]
+        return self.type
+
+    def key(self):
+        return (self.version, self.ip, self.prefixlen)
+
+    def __eq__(self, other):
+        if not isinstance(other, IPAddress):
+            return False
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __lt__(self, other):
+        if not isinstance(other, IPAddress):
+            return NotImplemented
+        return self.key() < other.key()
+
+    def __le__(self, other):
+        if not isinstance(other, IPAddress):
+            return NotImplemented
+        return self.key() <= other.key()
+
+    def __gt__(self, other):
+        if not isinstance(other, IPAddress):
+            return NotImplemented
+        return self.key() > other.key()
+
+    def __ge__(self, other):
+        if not isinstance(other, IPAddress):
+            return NotImplemented
+        return self.key() >= other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "IPAddress('%s')" %(self.text)
+
+    def __getstate__(self):
+        return (self.version, self.ip, self.prefixlen, self.text)
+
+    def __setstate__(self, state):
+        self.version, self.ip, self.prefixlen, self.text = state
+        self.type = None
+
+
+def ipRanges(iprange, bits):
+    """Flattens an IPy range table (bit string prefix -> type) into sorted
+    integer intervals, so the longest matching prefix of an address is found
+    with one bisection. Returns a tuple (boundaries, types): addresses from
+    boundaries[k] to boundaries[k+1]-1 have type types[k].
+
+    iprange -- IPy range table (IPy.IPv4ranges or IPy.IPv6ranges).
+    bits    -- Address length in bits.
+    """
+    prefixes = {}
+    boundaries = set([0])
+    for prefix in iprange:
+        value = int(prefix, 2)
+        prefixes[(len(prefix), value)] = iprange[prefix]
+        boundaries.add(value << (bits - len(prefix)))
+        boundaries.add((value + 1) << (bits - len(prefix)))
+    boundaries = sorted(b for b in boundaries if b < (1 << bits))
+
+    lengths = sorted(set(length for length, value in prefixes), reverse=True)
+    types = []
+    for b in boundaries:
+        iptype = "unknown"
+        for length in lengths:
+            if (length, b >> (bits - length)) in prefixes:
+                iptype = prefixes[(length, b >> (bits - length))]
+                break
+        types.append(iptype)
+
+    return boundaries, types
+
+
+# Integer intervals of the IPy address types, for each IP version
+IP_RANGES = {4: ipRanges(IPv4ranges, 32), 6: ipRanges(IPv6ranges, 128)}
+
+IP_CACHE_SIZE = 65536       # distinct IP raw values kept by parseIp
+
+
+@lru_cache(maxsize=IP_CACHE_SIZE)
+def parseIp(raw_value):
+    """Converts a raw value into an IPAddress object. Results are cached,
+    as network data repeats the same addresses over and over.
+    Returns: IPAddress object, if the conversion succeeds;
+             None, if the conversion fails (a warning is printed the first time).
+
+    raw_value -- The input raw value, representing a IP address (eg. '192.168.1.1'),
+                 or an IPAddress object, as decoded from binary data.
+    """
+    if isinstance(raw_value, IPAddress):
+        return raw_value
+
+    # Fast path: plain dotted quads
+    if isinstance(raw_value, str) and raw_value.count('.') == 3:
+        try:
+            a, b, c, d = map(int, raw_value.split('.'))
+            if 0 <= a < 256 and 0 <= b < 256 and 0 <= c < 256 and 0 <= d < 256 and '%d.%d.%d.%d' %(a, b, c, d) == raw_value:
+                return IPAddress(4, (a << 24) | (b << 16) | (c << 8) | d, 32, raw_value)
+        except ValueError:
+            pass
+
+    # Any other representation supported by IPy (IPv6, networks, short forms...)
+    try:
+        ipaddr = IP(raw_value)
+    except:
+        print('\033[33m'+ "Error while processing IP: '%s'" %(raw_value) +'\033[m')
+        return None
+
+    return IPAddress(ipaddr.version(), ipaddr.int(), ipaddr.prefixlen(), str(ipaddr))
+
+
 #-----------------------------------------------------------------------
 # Record Class
 #-----------------------------------------------------------------------
@@ -341,9 +635,9 @@ class Record(object):
     def __init__(self, line, variables, structured, tsformat, all=False):
         self.variables = {}
         
-        # For structured sources
+        # For structured sources (entries may be given already split into fields)
         if structured:
-            raw_values = line.split(',')
+            raw_values = line if isinstance(line, tuple) else line.split(',')
             #print(raw_values)
 
             for v in variables:
@@ -476,6 +770,16 @@ class Record(object):
         return self.variables.__str__()
 
 
+def selectVariables(variables, names):
+    """Returns the configurations of the variables with the given names, in
+    configuration order. Records built from them only parse those variables.
+
+    variables -- List of variables configurations.
+    names     -- Set of variable names.
+    """
+    return [v for v in variables if v['name'] in names]
+
+
 #-----------------------------------------------------------------------
 # Feature Class
 #-----------------------------------------------------------------------
@@ -640,6 +944,493 @@ class NullFeature(Feature):
     def __init__(self):
         super(NullFeature, self).__init__({'name': "Null", 'variable': 'null', 'value': 0})
 
+
+# Variable and feature classes for each matchtype
+VARIABLE_TYPES = {'string': StringVariable, 'number': NumberVariable, 'ip': IpVariable,
+                  'time': TimeVariable, 'duration': TimedeltaVariable}
+
+FEATURE_TYPES = {'single': SingleFeature, 'multiple': MultipleFeature, 'range': RangeFeature,
+                 'regexp': RegExpFeature, 'default': DefaultFeature, 'total': TotalFeature}
+
+
+def loadValue(vType, raw_value, tsformat=None):
+    """Converts a raw value from the configuration file in the same way
+    the values of a variable with matchtype vType are converted.
+
+    vType     -- Matchtype of the variable.
+    raw_value -- The raw value (e.g. the value field of a feature).
+    tsformat  -- Timestamp format, only used for 'time' variables.
+    """
+    vClass = VARIABLE_TYPES.get(vType, StringVariable)
+    variable = vClass.__new__(vClass)
+    if vType == 'time':
+        return variable.load(raw_value, tsformat)
+    return variable.load(raw_value)
+
+
+#-----------------------------------------------------------------------
+# RangeIndex Class
+#-----------------------------------------------------------------------
+
+class RangeIndex(object):
+    """Interval index over the range features of a variable.
+
+    The boundaries of all the ranges are sorted once. Each boundary, and each
+    gap between two consecutive boundaries, stores the features whose range
+    contains it, so a value is resolved with a single bisection.
+
+    Class Attributes:
+        points  -- Sorted list of range boundaries.
+        at      -- Features matching each boundary.
+        between -- Features matching the values between two boundaries
+                   (between[k] lies below points[k]).
+    """
+    def __init__(self, ranges):
+        """Class constructor.
+
+        ranges -- List of (feature index, start, end), both inclusive.
+                  'None' end means infinite.
+        """
+        points = set()
+        for i, start, end in ranges:
+            points.add(start)
+            if end is not None:
+                points.add(end)
+        self.points = sorted(points)
+
+        self.at = []
+        for point in self.points:
+            self.at.append(tuple(i for i, start, end in ranges if start <= point and (end is None or point <= end)))
+
+        self.between = [()]     # below every boundary
+        for k in range(1, len(self.points)):
+            low, high = self.points[k-1], self.points[k]
+            self.between.append(tuple(i for i, start, end in ranges if start <= low and (end is None or high <= end)))
+        self.between.append(tuple(i for i, start, end in ranges if end is None))
+
+
+    def lookup(self, value):
+        """Returns the indices of the range features containing a value.
+        """
+        k = bisect_left(self.points, value)
+        if k < len(self.points) and self.points[k] == value:
+            return self.at[k]
+        return self.between[k]
+
+
+#-----------------------------------------------------------------------
+# RegexpIndex Class
+#-----------------------------------------------------------------------
+
+class RegexpIndex(object):
+    """Combined matcher for the regexp features of a variable.
+
+    The regular expressions are joined into a single pattern in which every
+    feature is an optional lookahead with its own named group:
+        (?:(?=(?P<_f0>regexp0))|)(?:(?=(?P<_f1>regexp1))|)...
+    One match call then tells which of the features match the value, just
+    like calling match() with each regular expression. Regular expressions
+    that can not be combined (backreferences, conflicting group names...)
+    are matched one by one.
+
+    Class Attributes:
+        combined -- Compiled combined pattern (or None).
+        groups   -- Tuple of (position in match.groups(), feature index) for the
+                    features in the combined pattern.
+        fallback -- Tuple of (feature index, compiled regexp) matched one by one.
+    """
+    def __init__(self, regexps):
+        """Class constructor.
+
+        regexps -- List of (feature index, compiled regexp).
+        """
+        combinable = []
+        fallback = []
+        names = set()
+        for i, r_Comp in regexps:
+            if re.search(r'\\[1-9]|\(\?P=', r_Comp.pattern) or r_Comp.flags & ~re.UNICODE or names.intersection(r_Comp.groupindex):
+                fallback.append((i, r_Comp))
+            else:
+                combinable.append((i, r_Comp))
+                names.update(r_Comp.groupindex)
+
+        self.combined = None
+        self.groups = ()
+        if combinable:
+            try:
+                self.combined = re.compile(''.join("(?:(?=(?P<_f%d>%s))|)" %(i, r_Comp.pattern) for i, r_Comp in combinable))
+                self.groups = tuple((self.combined.groupindex['_f%d' %(i)] - 1, i) for i, r_Comp in combinable)
+            except (re.error, KeyError):
+                fallback = fallback + combinable
+        self.fallback = tuple(fallback)
+
+
+    def lookup(self, text):
+        """Returns the indices of the regexp features matching a string.
+        """
+        found = []
+        if self.combined is not None:
+            matches = self.combined.match(text).groups()
+            for group, i in self.groups:
+                if matches[group] is not None:
+                    found.append(i)
+        for i, r_Comp in self.fallback:
+            if r_Comp.match(text):
+                found.append(i)
+        return found
+
+
+#-----------------------------------------------------------------------
+# FeaturePlan Class
+#-----------------------------------------------------------------------
+
+class FeaturePlan(object):
+    """Compiled evaluation plan for the features of a data source.
+
+    The plan is built once, when the configuration is loaded. Each feature
+    is validated and turned into a matcher whose constant is already
+    converted to the matchtype of its variable. Matchers are grouped by
+    variable, so each variable of a record is visited once per record.
+
+    Single and multiple features are folded into one hash table per variable
+    (value -> features), so they cost one lookup per variable instance. For
+    IP variables, 'private' and 'public' features are stored in the same
+    table under an ('iptype', type) key, which is looked up as a second key.
+    Range features are resolved through a RangeIndex per variable, and
+    regexp features through a RegexpIndex per variable, which matches the
+    string of each variable instance once.
+
+    Class Attributes:
+        names     -- Feature names, in configuration order.
+        variables -- Variable of each feature, in configuration order.
+        members   -- Dictionary of the feature indices of each variable.
+        groups    -- Tuple of (variable name, index, iptype, ranges, regexps, matchers,
+                     defaults), where index is a dict of value -> tuple of (matchtype,
+                     feature index), iptype tells whether the IP type is looked up
+                     as well, ranges is a RangeIndex (or None), regexps is a
+                     RegexpIndex (or None), matchers is a tuple of (matchtype,
+                     feature index, constant) for the remaining features and
+                     defaults is a tuple of default feature indices.
+    """
+    def __init__(self, FEATURES, VARIABLES, tsformat=None):
+        """Class constructor.
+
+        FEATURES -- List of features configurations.
+        VARIABLES -- List of variables configurations.
+        tsformat -- Timestamp format of the data source.
+        """
+        vTypes = {}
+        for v in VARIABLES:
+            vTypes[str(v['name'])] = v['matchtype']
+
+        names = []
+        variables = []
+        indexes = {}
+        iptypes = {}
+        ranges = {}
+        regexps = {}
+        matchers = {}
+        defaults = {}
+
+        for i in range(len(FEATURES)):
+            try:
+                fType = FEATURES[i]['matchtype']
+                fVariable = FEATURES[i]['variable']
+                if fType not in FEATURE_TYPES:
+                    raise ConfigError(self, "FEATURES: illegal matchtype in \'%s\' (%s)" %(FEATURES[i]['name'], fType))
+
+                # Feature constructors validate the value field
+                feature = FEATURE_TYPES[fType](FEATURES[i])
+
+            except KeyError as e:
+                raise ConfigError(self, "FEATURES: missing config key (%s)" %(e))
+
+            names.append(feature.fName)
+            variables.append(fVariable)
+            index = indexes.setdefault(fVariable, {})
+            iptypes.setdefault(fVariable, False)
+            ranges.setdefault(fVariable, [])
+            regexps.setdefault(fVariable, [])
+            matchers.setdefault(fVariable, [])
+            defaults.setdefault(fVariable, [])
+            vType = vTypes.get(fVariable)
+
+            if fType == 'single':
+                if vType == 'ip' and feature.fValue in ('private', 'public'):
+                    iptypes[fVariable] = True
+                    value = ('iptype', feature.fValue.upper())  # as returned by IPAddress.iptype()
+                else:
+                    value = loadValue(vType, feature.fValue, tsformat)
+                if value is not None:                   # None never matches a variable value
+                    index[value] = index.get(value, ()) + (('single', i),)
+            elif fType == 'multiple':
+                for value in set(feature.fValue):
+                    index[value] = index.get(value, ()) + (('multiple', i),)
+            elif fType == 'range':
+                start = loadValue(vType, feature.start, tsformat)
+                end = None
+                if feature.end is not None:
+                    end = loadValue(vType, feature.end, tsformat)
+                if start is not None:                   # None start never matches
+                    ranges[fVariable].append((i, start, end))
+            elif fType == 'regexp':
+                regexps[fVariable].append((i, feature.r_Comp))
+            elif fType == 'total':
+                matchers[fVariable].append(('total', i, None))
+            else:
+                defaults[fVariable].append(i)
+
+        # Index the ranges of each variable. Boundaries that can not be sorted
+        # together (mixed types) are evaluated one by one instead.
+        for vName in ranges:
+            if ranges[vName]:
+                try:
+                    ranges[vName] = RangeIndex(ranges[vName])
+                except TypeError:
+                    for i, start, end in ranges[vName]:
+                        matchers[vName].append(('range', i, (start, end)))
+                    ranges[vName] = None
+            else:
+                ranges[vName] = None
+
+        for vName in regexps:
+            if regexps[vName]:
+                regexps[vName] = RegexpIndex(regexps[vName])
+            else:
+                regexps[vName] = None
+
+        self.names = tuple(names)
+        self.variables = tuple(variables)
+        self.members = {}
+        for i in range(len(variables)):
+            self.members[variables[i]] = self.members.get(variables[i], ()) + (i,)
+        self.groups = tuple((vName, indexes[vName], iptypes[vName], ranges[vName], regexps[vName], tuple(matchers[vName]), tuple(defaults[vName])) for vName in matchers)
+
+
+    def evaluate(self, record):
+        """Runs the plan over a record.
+        Returns the list of feature counters, in configuration order.
+
+        record -- Record object.
+        """
+        counters = [0] * len(self.names)
+
+        for group in self.groups:
+            self.evaluateVariable(group, record.variables[group[0]], counters)
+
+        return counters
+
+
+    def evaluateVariable(self, group, variable, counters):
+        """Runs the features of a group over the instances of its variable,
+        increasing the counters in place.
+
+        group     -- Item of the groups attribute.
+        variable  -- List of instances of the variable in a record.
+        counters  -- List of feature counters.
+        """
+        vName, index, iptype, ranges, regexps, matchers, defaults = group
+        valid = False       # at least one instance of the variable has a value
+        matched = 0         # instances matching at least one feature
+
+        for var in variable:
+            if var is None or var.value is None:    # It is necessary to differentiate between var==None (no valid object) and
+                continue                            # var.value==None (valid object but a None in the value field)
+            valid = True
+            value = var.value
+            hit = False
+
+            if index:
+                found = index.get(value, ())
+                if iptype:
+                    found = found + index.get(('iptype', value.iptype()), ())
+                for fType, i in found:
+                    if fType == 'single':
+                        counters[i] += 1
+                        hit = True
+                    elif not counters[i]:   # multiple features count once per record
+                        counters[i] = 1
+                        hit = True
+
+            if ranges:
+                for i in ranges.lookup(value):
+                    counters[i] += 1
+                    hit = True
+
+            if regexps:
+                for i in regexps.lookup(str(var).replace('[','').replace(']','')):
+                    counters[i] += 1
+                    hit = True
+
+            for fType, i, constant in matchers:
+                if fType == 'range':
+                    start, end = constant
+                    if start is not None and value >= start and (end is None or value <= end):
+                        counters[i] += 1
+                        hit = True
+                else:
+                    counters[i] += 1
+                    hit = True
+
+            if hit:
+                matched += 1
+
+        # Default features count the instances not identified in other features
+        if valid:
+            for d in defaults:
+                counters[d] += len(variable) - matched
+
+
+    def evaluateColumns(self, columns, tags, ntags):
+        """Runs the plan over a batch of structured records parsed into columns.
+        Returns a (ntags x features) int64 matrix with the feature counters
+        of the records added up by tag.
+
+        Structured records hold a single instance of each variable, so the
+        features of a variable only depend on its value: they are evaluated
+        once per distinct value and the counters are added up with NumPy.
+
+        columns -- Dictionary of Column objects, indexed by variable name.
+        tags    -- numpy.ndarray with the tag index of each record (-1 for the
+                   records to leave out).
+        ntags   -- Number of tags.
+        """
+        output = np.zeros((ntags, len(self.names)), dtype=np.int64)
+        selected = tags >= 0
+        tags = tags[selected]
+        if not len(tags):
+            return output
+
+        for group in self.groups:
+            column = columns[group[0]]
+            members = self.members[group[0]]
+            nvalues = len(column.variables)
+
+            # Number of records of each (tag, value) pair
+            pairs, counts = np.unique(tags * nvalues + column.codes[selected], return_counts=True)
+            values = pairs % nvalues
+
+            table = np.zeros((nvalues, len(members)), dtype=np.int64)
+            for u in np.unique(values).tolist():
+                counters = [0] * len(self.names)
+                self.evaluateVariable(group, [column.variables[u]], counters)
+                table[u] = [counters[i] for i in members]
+
+            np.add.at(output, ((pairs // nvalues)[:, None], np.array(members)[None, :]), counts[:, None] * table[values])
+
+        return output
+
+
+#-----------------------------------------------------------------------
+# Column Class
+#-----------------------------------------------------------------------
+
+class Column(object):
+    """Variable of a batch of structured records, in columnar form.
+
+    The column is dictionary encoded: each distinct raw value is converted
+    once, with the same Variable class used by Record, and each record
+    keeps the code of its value.
+
+    Class Attributes:
+        variables -- List of Variable objects, one per distinct raw value.
+        codes     -- numpy.ndarray with the code of the value of each record.
+    """
+    def __init__(self, raw_values, vType, tsformat=None):
+        """Class constructor.
+
+        raw_values -- List of raw values (pairs of raw values for 'duration'),
+                      as strings, bytes or values already typed.
+        vType      -- Matchtype of the variable.
+        tsformat   -- Timestamp format, only used for 'time' variables.
+        """
+        table = {}
+        self.codes = np.array([table.setdefault(raw, len(table)) for raw in raw_values], dtype=np.int64)
+
+        self.variables = []
+        for raw in table:
+            # Raw values read from the file as bytes are decoded here, once per distinct value
+            if isinstance(raw, bytes):
+                raw = raw.decode()
+            elif isinstance(raw, tuple):
+                raw = tuple(r.decode() if isinstance(r, bytes) else r for r in raw)
+
+            if vType == 'time':
+                self.variables.append(TimeVariable(raw, tsformat))
+            elif vType == 'duration':
+                self.variables.append(TimedeltaVariable(raw[0], raw[1]))
+            else:
+                self.variables.append(VARIABLE_TYPES[vType](raw))
+
+
+def parseColumns(lines, variables, tsformat):
+    """Parses a batch of structured data entries into one Column per variable.
+    Returns a tuple (columns, rest): the dictionary of Column objects indexed
+    by variable name and the list of entries left out, which must be parsed
+    one by one through Record (empty entries, entries missing some field, or
+    variable configurations that are not supported in columnar form).
+
+    Entries can be given as bytes, as read from a DataFile: fields are then
+    only decoded by the columns, once per distinct value, and the entries
+    left out are returned decoded. Entries can also be given as tuples of
+    fields already split and typed, as decoded from binary data (nfcapd).
+
+    lines     -- List of data entries (strings, bytes or tuples).
+    variables -- List of variables configurations.
+    tsformat  -- Timestamp format of the data source.
+    """
+    if lines and isinstance(lines[0], bytes):
+        split = lambda line: line.split(b',')
+        decode = lambda lines: [line.decode() for line in lines]
+        empty = lambda line: not line.strip() or (not line.isascii() and not line.decode().strip())
+    elif lines and isinstance(lines[0], tuple):
+        split = lambda line: line
+        decode = lambda lines: lines
+        empty = lambda line: not line
+    else:
+        split = lambda line: line.split(',')
+        decode = lambda lines: lines
+        empty = lambda line: not line.strip()
+
+    wheres = []
+    for v in variables:
+        vWhere = v.get('where')
+        if (not v.get('name') or v.get('mult') or v.get('matchtype') not in VARIABLE_TYPES
+                or (v['matchtype'] == 'duration') != isinstance(vWhere, list)):
+            return {}, decode(lines)
+        if isinstance(vWhere, list):
+            if len(vWhere) != 2 or not all(type(w) is int for w in vWhere):
+                return {}, decode(lines)
+            wheres.extend(vWhere)
+        elif type(vWhere) is int:
+            wheres.append(vWhere)
+        else:
+            return {}, decode(lines)
+
+    high = max(wheres) if wheres else 0
+    low = min(wheres) if wheres else 0
+    rows = []
+    rest = []
+    for line in lines:
+        raw_values = split(line)
+        if len(raw_values) > high and len(raw_values) >= -low and not empty(line):
+            rows.append(raw_values)
+        else:
+            rest.append(line)
+    rest = decode(rest)
+
+    columns = {}
+    for v in variables:
+        vWhere = v['where']
+        if isinstance(vWhere, list):
+            raw_values = [(r[vWhere[0]], r[vWhere[1]]) for r in rows]
+        else:
+            raw_values = [r[vWhere] for r in rows]
+        columns[str(v['name'])] = Column(raw_values, v['matchtype'], tsformat)
+
+    return columns, rest
+
+
 #-----------------------------------------------------------------------
 # Observation Class
 #-----------------------------------------------------------------------
@@ -658,80 +1449,34 @@ class Observation(object):
     An observation looks like this:
     [0, 1, 0, 0, 2, 0, 0, 0, 3, 1, 0, ...]
 
+    The counters are stored in an int64 NumPy vector, so aggregating, fusing
+    and padding observations are vector operations. Feature names and
+    variables are not copied into each observation: they are shared through
+    the plan of the data source.
+
     Class Attributes:
-        data  -- Array of data values.
+        data  -- Array of data values (numpy.ndarray of int64).
+        plan  -- FeaturePlan that produced the data (feature names and variables).
 
     """
 
 
-    def __init__(self, data, debug=None):
+    def __init__(self, data, plan=None):
 
-        self.data = data
+        self.data = np.asarray(data, dtype=np.int64)
+        self.plan = plan
 
         
     @classmethod
-    def fromRecord(cls, record, FEATURES):
+    def fromRecord(cls, record, plan):
         """Creates an observation from a record of variables.
-        record    -- Record object.
-        FEATURES -- List of features configurations."""
-
-        data  = [None] * len(FEATURES)      # Data array (counters)
-        defaults = []                       # tracks default features
-        matched_variables = []              # List of variables from record matching at least one defined feature
-        
-
-        for i in range(len(FEATURES)):
-            try:
-                fType  = FEATURES[i]['matchtype']
-
-                # Validate matchtype
-                if fType == 'single':
-                    feature = SingleFeature(FEATURES[i])
-                elif fType == 'multiple':
-                    feature = MultipleFeature(FEATURES[i])
-                elif fType == 'range':
-                    feature = RangeFeature(FEATURES[i])
-                elif fType == 'regexp':
-                    feature = RegExpFeature(FEATURES[i])
-                elif fType == 'default':
-                    feature = DefaultFeature(FEATURES[i])
-                elif fType == 'total':
-                    feature = TotalFeature(FEATURES[i])
-                else:
-                    raise ConfigError(cls, "FEATURES: illegal matchtype in \'%s\' (%s)" %(FEATURES[i]['name'], fType))
-
-
-            except KeyError as e:
-                raise ConfigError(cls, "FEATURES: missing config key (%s)" %(e))
+        record -- Record object.
+        plan   -- FeaturePlan of the data source."""
 
-
-            # Calculate feature 
-
-            # Iterate through all the features in the conf file. For each iteration, check the matchtype of the variable 
-            # involved. Then, check the value of the variable asociated to the feature. If there is a match, the counters
-            # of the observations are increased. --> FaaC (Feature as a counter)
-            variable = record.variables[FEATURES[i]['variable']]
-
-            data[i]  = feature
-            
-            for var in variable:
-                if var is not None:     # It is necessary to differentiate between var==None (no valid object) and 
-                    if var.value is not None:       # var.value==None (valid object but a None in the value field)       
-                        if fType == 'default':
-                            if i not in defaults:
-                                defaults.append(i)
-                        else:
-                            old_data_value = data[i].value
-                            data[i].add(var)    # This method sums 1 or 0 depending if variable satisfies feature value
-                            if (data[i].value - old_data_value) > 0 and (var not in matched_variables):
-                                matched_variables.append(var)   # store variables that match at least one feature 
-
-        # Calculate default features counters
-        for d in defaults:
-            data[d].add(record.variables, matched_variables)
-            
-
-        return cls(data)        
+        # Iterate through all the variables used by the features in the conf file. For each instance of a variable, 
+        # check the matchers of the features defined from it. If there is a match, the counters of the observation
+        # are increased. --> FaaC (Feature as a counter)
+        return cls(plan.evaluate(record), plan)
 
             
     def aggregate(self, obs):
@@ -740,10 +1485,9 @@ class Observation(object):
         """
         
         try:
-            for i in range(len(self.data)):
-                self.data[i].aggregate(obs.data[i])
-        except IndexError as e:
-            raise AggregateError (self, "Unable to aggregate data arrays (%s)" %(e.message))
+            self.data += obs.data
+        except ValueError as e:
+            raise AggregateError (self, "Unable to aggregate data arrays (%s)" %(e))
 
 
     def fuse(self, data):
@@ -751,16 +1495,16 @@ class Observation(object):
             obs -- Observation object to merge with.
 
         """
-        self.data += data
+        self.data = np.concatenate((self.data, data))
 
 
     def zeroPadding(self, N, position=-1):
     
         try:
             if (position == 0):
-                self.data = self.data + [NullFeature()] * N
+                self.data = np.concatenate((self.data, np.zeros(N, dtype=np.int64)))
             elif (position == -1):
-                self.data = [NullFeature()] * N + self.data
+                self.data = np.concatenate((np.zeros(N, dtype=np.int64), self.data))
             else:
                 raise Exception
         except:
@@ -774,6 +1518,179 @@ class Observation(object):
         return self.data.__str__()
 
 
+#-----------------------------------------------------------------------
+# Counters Class
+#-----------------------------------------------------------------------
+
+COUNTERS_MIN_ROWS = 64      # initial capacity of a Counters matrix, in rows
+
+
+class Counters(object):
+    """Feature counters of the observations of a data source, indexed by key.
+
+    Compact form of a dictionary of Observation objects (key -> Observation),
+    used for the partial results of the processes and for the results they
+    are merged into. The counters of all the keys are the rows of one int64
+    matrix, so merging two of them adds rows of matrices and creates no
+    object per observation. The matrix has spare rows at the end, and it is
+    reallocated with twice the rows when they run out.
+
+    Keys are window ids, or tuples (window id, values of the aggregation
+    keys). When pickled, only the rows in use are kept, and the keys are
+    dictionary-encoded: an array of window ids, the number of key values of
+    each row, and for each position of the key values, an array of codes into
+    a table of its distinct values. Matrices with less than half of their
+    counters set are pickled in sparse form (positions and values).
+
+    Class Attributes:
+        keys  -- List of keys, in row order.
+        rows  -- Dictionary of row numbers, indexed by key.
+        data  -- Matrix of counters (numpy.ndarray of int64), one row per key.
+    """
+    def __init__(self, nfeatures):
+        """Class constructor. Creates empty counters.
+
+        nfeatures -- Number of features (columns of the matrix).
+        """
+        self.keys = []
+        self.rows = {}
+        self.data = np.zeros((COUNTERS_MIN_ROWS, nfeatures), dtype=np.int64)
+
+    def grow(self, nrows):
+        """Reallocates the matrix of counters if it has less than nrows rows.
+        """
+        capacity = len(self.data)
+        if nrows > capacity:
+            spare = np.zeros((max(nrows, 2 * capacity, COUNTERS_MIN_ROWS) - capacity, self.data.shape[1]), dtype=np.int64)
+            self.data = np.concatenate((self.data, spare))
+
+    def index(self, key):
+        """Adds a row for a new key and returns its number.
+        """
+        row = len(self.keys)
+        self.grow(row + 1)
+        self.keys.append(key)
+        self.rows[key] = row
+        return row
+
+    def add(self, key, data):
+        """Adds the counters of an observation to the row of its key.
+
+        key  -- Key of the observation.
+        data -- Vector of counters.
+        """
+        row = self.rows.get(key)
+        if row is None:
+            row = self.index(key)
+        self.data[row] += data
+
+    def update(self, keys, data, start=0):
+        """Adds the counters of several observations to the rows of their keys.
+
+        keys  -- List of distinct keys.
+        data  -- Matrix of counters, one row per key.
+        start -- First column of the matrix where the counters are added.
+        """
+        rows = [self.rows.get(key) for key in keys]
+
+        # New keys are appended at once
+        new = [i for i in range(len(rows)) if rows[i] is None]
+        if new:
+            first = len(self.keys)
+            self.grow(first + len(new))
+            for n, i in enumerate(new):
+                rows[i] = first + n
+            self.keys.extend([keys[i] for i in new])
+            self.rows.update(zip(self.keys[first:], range(first, len(self.keys))))
+
+        self.data[rows, start:start + data.shape[1]] += data
+
+    def partition(self, nparts):
+        """Splits the counters by window id (modulo nparts) into a list of nparts Counters.
+        The keys of different parts never match, so each part can be merged separately.
+        """
+        windows = np.array([key[0] if isinstance(key, tuple) else key for key in self.keys], dtype=np.int64)
+        parts = list()
+        for part in range(nparts):
+            rows = np.flatnonzero(windows % nparts == part)
+            counters = Counters(self.data.shape[1])
+            counters.keys = [self.keys[row] for row in rows.tolist()]
+            counters.rows = dict(zip(counters.keys, range(len(rows))))
+            counters.data = self.data[rows]
+            parts.append(counters)
+        return parts
+
+    def aggregate(self, counters):
+        """Adds other counters of the same features to these ones.
+        """
+        self.update(counters.keys, counters.data[:len(counters.keys)])
+
+    def observations(self, plan=None):
+        """Returns the dictionary of Observation objects, indexed by key.
+        """
+        return {key: Observation(self.data[row], plan) for key, row in self.rows.items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        n = len(self.keys)
+        widths = np.fromiter((len(key) - 1 if isinstance(key, tuple) else 0 for key in self.keys), dtype=np.int8, count=n)
+        width = int(widths.max()) if n else 0
+
+        # Keys are split into columns (padded with None when they have different lengths)
+        if not width:
+            columns = [self.keys]
+        elif widths.min() == width:
+            columns = list(zip(*self.keys))
+        else:
+            columns = list(zip(*[key + (None,) * (width + 1 - len(key)) if isinstance(key, tuple)
+                                 else (key,) + (None,) * width for key in self.keys]))
+
+        windows = np.array(columns[0], dtype=np.int64)
+        tables = []
+        codes = []
+        for column in columns[1:]:
+            table = {}
+            codes.append(np.fromiter((table.setdefault(value, len(table)) for value in column), dtype=np.int32, count=n))
+            tables.append(list(table))
+        state = {'windows': windows, 'widths': widths, 'codes': codes, 'tables': tables}
+
+        data = self.data[:n]
+        nonzero = np.flatnonzero(data)
+        if len(nonzero) < data.size // 2:
+            state['shape'] = data.shape
+            state['nonzero'] = nonzero.astype(np.uint32 if data.size <= 0xFFFFFFFF else np.int64)
+            state['values'] = data.reshape(-1)[nonzero]
+        else:
+            state['data'] = data
+        return state
+
+    def __setstate__(self, state):
+        columns = [state['windows'].tolist()]
+        for table, codes in zip(state['tables'], state['codes']):
+            values = np.empty(len(table), dtype=object)
+            values[:] = table
+            columns.append(values[codes].tolist())
+
+        if len(columns) == 1:
+            self.keys = columns[0]
+        else:
+            self.keys = list(zip(*columns))
+            widths = state['widths']
+            if len(widths) and widths.min() < len(columns) - 1:
+                self.keys = [key[:width + 1] if width else key[0] for key, width in zip(self.keys, widths.tolist())]
+        self.rows = dict(zip(self.keys, range(len(self.keys))))
+        if 'data' in state:
+            self.data = state['data']
+        else:
+            self.data = np.zeros(state['shape'], dtype=np.int64)
+            self.data.reshape(-1)[state['nonzero']] = state['values']
+
+    def __repr__(self):
+        return "<%s - %d keys, %d vars>" %(self.__class__.__name__, len(self.keys), self.data.shape[1])
+
+
 #-----------------------------------------------------------------------
 # Exception and Error Classes
 #-----------------------------------------------------------------------
@@ -830,10 +1747,11 @@ def getConfiguration(config_file):
     return conf
 
 
-def loadConfig(parserConfig, caller, debugmode):
+def loadConfig(parserConfig, caller, debugmode, export=False):
     '''
     Function to load configuration from the config files.
-    Caller function is fcparser, fcdeparser or fclearner
+    Caller function is fcparser, fcdeparser or fclearner. When export is set (fcparser --export),
+    the output directory is never cleared.
     '''
     
     # Config dictionary which stores all the entries necessary for processing (the parameters
@@ -953,6 +1871,37 @@ def loadConfig(parserConfig, caller, debugmode):
             paramWarnings += 1
             
             
+    # Memory parameter (only for offline mode). Optional: chunk and batch sizes are derived from it, but
+    # it does not bound the memory of the merged observations
+    config['Memory'] = None
+    if 'memory' in parserConfig_low:
+        try:
+            config['Memory'] = 1024 * 1024 * int(parserConfig_low['memory'])
+            if config['Memory'] <= 0:
+                raise ValueError
+            if not debugmode:
+                print("* Memory: %s MB" %(str(int(parserConfig_low['memory']))))
+        except:
+            print('\033[31m'+ "**CONFIG FILE ERROR** Memory must be a positive number of MB" +'\033[m')
+            exit(1)
+
+    # Disk space for the recompressed copies of compressed inputs (optional). Without it, compressed
+    # files with no access points are read sequentially
+    global INDEX_COPY_LIMIT
+    config['Index_cache'] = 0
+    if 'index_cache' in parserConfig_low:
+        try:
+            config['Index_cache'] = 1024 * 1024 * int(parserConfig_low['index_cache'])
+            if config['Index_cache'] < 0:
+                raise ValueError
+            if not debugmode:
+                print("* Index_cache: %s MB" %(str(int(parserConfig_low['index_cache']))))
+        except:
+            print('\033[31m'+ "**CONFIG FILE ERROR** Index_cache must be a number of MB (0 for no recompressed copies)" +'\033[m')
+            exit(1)
+    INDEX_COPY_LIMIT = config['Index_cache']
+    trimIndexCache()
+
     # Chunk size parameter (only for offline mode)
     try:
         if caller == 'fcparser' and online is False or caller == 'fclearner' or caller == 'fcdeparser':
@@ -961,11 +1910,20 @@ def loadConfig(parserConfig, caller, debugmode):
                 if not debugmode:
                     print("* Max_chunk: %s MB" %(str(int(parserConfig_low['max_chunk']))))
             except:
-                paramWarnings+=1
-                config['Csize'] = 1024 * 1024 * 1000 * config['Cores'];
-                if not debugmode:
-                    print('\033[33m'+ "**CONFIG FILE WARNING** missing field: Max_chunk")
-                    print(" * Setting default max_chunk size: 1000 MB" +'\033[m')  # To understand why default chunk size is 1000MB, check calling of frag function in fcparser.process_multifile()
+                if config['Memory']:
+                    config['Csize'] = config['Memory']
+                else:
+                    paramWarnings+=1
+                    config['Csize'] = 1024 * 1024 * 1000 * config['Cores'];
+                    if not debugmode:
+                        print('\033[33m'+ "**CONFIG FILE WARNING** missing field: Max_chunk")
+                        print(" * Setting default max_chunk size: 1000 MB" +'\033[m')  # To understand why default chunk size is 1000MB, check calling of frag function in fcparser.process_multifile()
+
+            # Share of the Memory size for each process (the main one included), which bounds its chunks and batches
+            if config['Memory']:
+                config['Psize'] = config['Memory'] // (config['Cores'] + 1)
+            else:
+                config['Psize'] = None
             
     except:
         pass   
@@ -976,14 +1934,16 @@ def loadConfig(parserConfig, caller, debugmode):
     try: 
         parserConfig_low['split'] =  {k.lower(): v for k, v in parserConfig_low['split'].items()}
         config['Time'] = parserConfig_low['split']['time']
+        if not config['Time']['window'] or int(config['Time']['window'] * 60) <= 0:
+            print('\033[31m'+ "**CONFIG FILE ERROR** Time sampling window must be a positive number of minutes" +'\033[m')
+            exit(1)
         if not debugmode:
             if config['Time']['window'] <= 60:
                 print("* Time sampling window: %d minutes" %(config['Time']['window']))
             elif config['Time']['window'] <= 1440:
                 print("* Time sampling window: %dh %dmin" %(config['Time']['window']/60, config['Time']['window']%60))
             else:
-                print('\033[31m'+ "**CONFIG FILE ERROR** Time sampling window above day is not implemented" +'\033[m')
-                exit(1)
+                print("* Time sampling window: %dd %dh %dmin" %(config['Time']['window']/1440, config['Time']['window']%1440/60, config['Time']['window']%60))
     except KeyError as key:
         if key.args[0] == 'split' and not debugmode: 
             print('\033[33m'+ "**CONFIG FILE WARNING** missing field: SPLIT" +'\033[m')
@@ -1037,6 +1997,12 @@ def loadConfig(parserConfig, caller, debugmode):
         config['All'] = bool(parserConfig_low['all'])
     else:
         config['All'] = False
+
+    # 'Count_entries' parameter. If true, data entries are counted before parsing (otherwise they are counted while parsed).
+    if 'count_entries' in parserConfig_low:
+        config['Count'] = bool(parserConfig_low['count_entries'])
+    else:
+        config['Count'] = False
              
 
     
@@ -1052,8 +2018,11 @@ def loadConfig(parserConfig, caller, debugmode):
         pass
 
     if not debugmode:
+        # The output directory is cleared, unless it keeps the state store of incremental runs
+        # or the output files are only exported from it
         try:
-            shutil.rmtree(config['OUTDIR']+'/')
+            if not config.get('Incremental') and not export:
+                shutil.rmtree(config['OUTDIR']+'/')
         except:
             pass
     
@@ -1085,6 +2054,15 @@ def loadConfig(parserConfig, caller, debugmode):
             print(" ** Defining default weights file: '%s'" %(config['OUTW']))
     except:
         pass
+
+    # Output format: text files per window, a binary matrix for the whole run, or both
+    try:
+        config['OUTFORMAT'] = str(output['format']).lower()
+    except (KeyError, TypeError, UnboundLocalError):
+        config['OUTFORMAT'] = 'text'
+    if caller == 'fcparser' and config['OUTFORMAT'] not in OUTPUT_FORMATS:
+        print('\033[31m'+ "**CONFIG FILE ERROR** Parsing_Output format must be one of: %s" %(', '.join(OUTPUT_FORMATS)) +'\033[m')
+        exit(1)
         
 
     # Sources settings. Data source config. file parameters stored in config[SOURCES] 
@@ -1140,6 +2118,14 @@ def loadConfig(parserConfig, caller, debugmode):
                     print('\033[31m'+ "**CONFIG FILE ERROR** missing field: 'learner' in '%s' data source" %(source) +'\033[m')
                     paramError = True
                 
+
+        # Compressed input files need the package of their format
+        for files in ('FILES', 'FILESDEP', 'FILESTRAIN'):
+            for fname in config['SOURCES'][source].get(files, []):
+                codec = detectCodec(fname)
+                if codec is not None and codec.decompressor is None:
+                    print('\033[31m'+ "**CONFIG FILE ERROR** '%s' is %s compressed, which requires the python package '%s'" %(fname, codec.name, codec.package) +'\033[m')
+                    paramError = True
         
     # Check everything is ok in general configuration file before loading datasources config. files
     if paramError is True:
@@ -1302,23 +2288,6 @@ def loadConfig(parserConfig, caller, debugmode):
                 print('\033[33m'+ "No timestamp variable has been found for '%s' data source" %(source) +'\033[m')                    
     
         
-        # Preprocessing nfcapd files to obtain csv files
-        if caller == 'fcparser':
-            for source in config['nfcapd_sources']:
-                out_files = []
-                for file in config['SOURCES'][source]['FILES']:
-                    file_path = '/'.join(file.split('/')[:-1])
-                    temp_file = file_path + '/temp_file'
-                    converted_file = file_path + '/' + 'nfcapd_converted.csv'
-                    print("Converting nfcapd binary file '%s' into .csv file format '%s'" %(file.split('/')[-1],converted_file.split('/')[-1]))
-                    os.system("nfdump -r " + file + " -o csv >>"+temp_file)
-                    os.system('tail -n +2 '+ temp_file + '>>' + temp_file.replace('temp','temp2')) # remove header
-                    os.system('head -n -3 ' + temp_file.replace('temp','temp2') + ' > ' + converted_file) # remove summary at the botton
-                    out_files.append(converted_file)
-                    os.remove(temp_file)    # remove temp files
-                    os.remove(temp_file.replace('temp','temp2'))
-                    config['SOURCES'][source]['FILES'] = out_files
-                    #delete_nfcsv = out_files
     
     
         # Process weight and made a list of features
@@ -1352,6 +2321,25 @@ def loadConfig(parserConfig, caller, debugmode):
                     config['weights'].append(str(fw))
 
 
+    # Compile the features of each data source into its evaluation plan
+    config['PLAN'] = {}
+    if caller == 'fcparser' or caller == 'fcdeparser':
+        for source in config['SOURCES']:
+            config['PLAN'][source] = FeaturePlan(config['FEATURES'][source], config['SOURCES'][source]['CONFIG']['VARIABLES'], config['TSFORMAT'][source])
+
+    # Variables parsed into the records of each data source: the ones used by the features, the timestamp
+    # and the keys. The learner counts the values of every variable, and debug mode shows them all.
+    config['RECORD_VARIABLES'] = {}
+    for source in config['SOURCES']:
+        if caller == 'fclearner' or debugmode:
+            config['RECORD_VARIABLES'][source] = config['SOURCES'][source]['CONFIG']['VARIABLES']
+        else:
+            names = set(feature['variable'] for feature in config['FEATURES'][source])
+            names.add(config['TIMEARG'][source])
+            names.update(config.get('Keys', []))
+            config['RECORD_VARIABLES'][source] = selectVariables(config['SOURCES'][source]['CONFIG']['VARIABLES'], names)
+
+
     return config
 
 
@@ -1455,13 +2443,12 @@ def debugProgram(caller, args):
             
                 
         if 'process_log.observation' in caller:
-            observation = args[0].data
-            print("\nObservation vector: %s" %(str(observation)))
+            observation = args[0]
+            print("\nObservation vector: %s" %(str(observation.data.tolist())))
             
             features_counter = {}
-            for obs in observation:
-                if obs.value:
-                    features_counter[obs.fName] = obs.value
+            for i in np.flatnonzero(observation.data):
+                features_counter[observation.plan.names[i]] = int(observation.data[i])
                     
             print("\nFeatures with counter>0: %s\n" %(features_counter))
             
@@ -1611,47 +2598,931 @@ def debugProgram(caller, args):
             exit(1)
                    
         
+#-----------------------------------------------------------------------
+# Codec Class
+#-----------------------------------------------------------------------
+
+class Codec(object):
+    """Compression format of input files, detected by the magic bytes at the
+    start of the file.
+
+    Compressed files are made of one or more frames (gzip members, bz2 and xz
+    streams, zstd and lz4 frames) that can be decompressed independently, so
+    their starts are the access points of the CompressedIndex of a file.
+
+    Class Attributes:
+        name         -- Name of the format.
+        magic        -- Magic bytes at the start of every frame.
+        package      -- Python package implementing the format (None for the standard library).
+        decompressor -- Function returning a decompressor of one frame (an object with decompress(),
+                        eof and unused_data, as zlib objects), None if the package is not installed.
+        reader       -- Function returning a binary stream of the uncompressed data of a file (path or binary file
+                        object, from its current position) to its end, across frames. None if the package is not installed.
+    """
+    def __init__(self, name, magic, package, decompressor, reader):
+        self.name = name
+        self.magic = magic
+        self.package = package
+        self.decompressor = decompressor
+        self.reader = reader
+
+    def open(self, file):
+        """Returns a binary stream of the uncompressed data of a file (path or binary file object).
+        """
+        return self.reader(file)
+
+    def __repr__(self):
+        return "<%s - %s>" %(self.__class__.__name__, self.name)
+
+
+CODECS = [Codec('gzip', b'\x1f\x8b', None, lambda: zlib.decompressobj(31), gzip.open),
+          Codec('bz2', b'BZh', None, bz2.BZ2Decompressor, bz2.BZ2File),
+          Codec('xz', b'\xfd7zXZ\x00', None, lzma.LZMADecompressor, lzma.LZMAFile),
+          Codec('zstd', b'\x28\xb5\x2f\xfd', 'zstandard',
+                zstandard and (lambda: zstandard.ZstdDecompressor().decompressobj()),
+                zstandard and (lambda f: zstandard.ZstdDecompressor().stream_reader(open(f, 'rb') if isinstance(f, str) else f,
+                                                                                  read_across_frames=True))),
+          Codec('lz4', b'\x04\x22\x4d\x18', 'lz4',
+                lz4frame and lz4frame.LZ4FrameDecompressor,
+                lz4frame and lz4frame.LZ4FrameFile)]
+
+
+def detectCodec(fname):
+    '''
+    Returns the Codec of a compressed file from its magic bytes, or None for uncompressed files.
+    '''
+    with open(fname, 'rb') as f:
+        head = f.read(6)
+    for codec in CODECS:
+        if head.startswith(codec.magic):
+            return codec
+    return None
+
+
+def openInput(fname):
+    '''
+    Opens an input file for sequential reading, as a binary stream of its (uncompressed) data.
+    '''
+    codec = detectCodec(fname)
+    if codec is None:
+        return open(fname, 'rb')
+    return codec.open(fname)
+
+
+#-----------------------------------------------------------------------
+# CompressedIndex Class
+#-----------------------------------------------------------------------
+
+INDEX_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fcparser')   # indexes and recompressed copies
+INDEX_SPAN = 1 << 22        # uncompressed bytes between the access points of a recompressed copy
+INDEX_COPY_LIMIT = 0        # bytes of recompressed copies kept in INDEX_CACHE_DIR (Index_cache parameter), 0 for no copies
+INDEX_COPIES_USED = set()   # recompressed copies used by this run, which are not removed to make room for others
+
+
+class CompressedIndex(object):
+    """Random access index of a compressed file.
+
+    An access point is an uncompressed offset where a frame starts, so
+    decompression can start there with no previous state. A chunk is read by
+    decompressing from the closest access point before it.
+
+    - BGZF files (gzip) and seekable zstd files: the block headers or the
+      seek table tell the sizes of the frames, so the access points are found
+      without decompressing anything and no index is stored.
+    - Other files are decompressed once. If their frames are close enough
+      (e.g. concatenated or rotated files, multi-frame zstd and lz4, pbzip2
+      and multi-threaded xz output), the frame starts are the access points.
+      Otherwise (typically a single frame), a frame can not be resumed in the
+      middle with the standard decompressors (and bz2 blocks are not even
+      byte-aligned), so the file is read sequentially, as one chunk. Only if
+      copies are allowed (INDEX_COPY_LIMIT), a gzip copy recompressed as one
+      member every INDEX_SPAN bytes is written, and the access points refer
+      to the copy.
+    The index of the other files, and the copy, are cached in INDEX_CACHE_DIR,
+    and rebuilt when the file changes. The copies take at most INDEX_COPY_LIMIT
+    bytes: the least recently used ones are removed to make room for a new
+    one, but not the ones used by the run, and a file whose copy does not fit
+    is read sequentially (until the limit is raised).
+
+    Class Attributes:
+        target     -- Path of the compressed file that the compressed offsets refer to.
+        codec      -- Codec of target.
+        points     -- Sorted list of uncompressed offsets of the access points.
+        offsets    -- Compressed offset of each access point in target.
+        size       -- Size of the uncompressed data.
+        sequential -- True if the access points are too far apart for chunks to start at them.
+    """
+    def __init__(self, fname, codec):
+        """Class constructor. Loads the index of a compressed file, building it if needed.
+
+        fname -- Path of the compressed file.
+        codec -- Codec of the file.
+        """
+        self.target = fname
+        self.codec = codec
+        if codec.name == 'gzip':
+            frames = bgzfBlocks(fname)
+        elif codec.name == 'zstd':
+            frames = zstdSeekTable(fname)
+        else:
+            frames = None
+        if frames is not None:
+            self.points, self.offsets, self.size = frames
+            self.sequential = False
+            return
+
+        status = os.stat(fname)
+        key = hashlib.sha1(("%s:%d:%d" %(os.path.abspath(fname), status.st_size, status.st_mtime_ns)).encode()).hexdigest()
+        index_path = os.path.join(INDEX_CACHE_DIR, key + '.idx')
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if 'size' not in index:
+                raise KeyError('size')      # index cached without the size of the data
+            if index['copy'] and not os.path.isfile(index['copy']):
+                raise IOError(index['copy'])
+            if not index['copy'] and INDEX_COPY_LIMIT > index.get('limit', 0) and sparsePoints(index['points'], index['size']):
+                raise IOError(fname)        # indexed when a copy was not allowed or did not fit
+        except (IOError, OSError, ValueError, KeyError):
+            index = buildIndex(fname, codec, os.path.join(INDEX_CACHE_DIR, key + '.gz') if INDEX_COPY_LIMIT else None)
+            index['limit'] = INDEX_COPY_LIMIT
+            try:
+                if not os.path.isdir(INDEX_CACHE_DIR):
+                    os.makedirs(INDEX_CACHE_DIR)
+                with open(index_path + '.tmp', 'w') as f:
+                    json.dump(index, f)
+                os.replace(index_path + '.tmp', index_path)
+            except (IOError, OSError):
+                print('\033[33m'+ "Warning: the index of '%s' could not be cached in %s" %(fname, INDEX_CACHE_DIR) +'\033[m')
+            if not index['copy'] and sparsePoints(index['points'], index['size']):
+                print('\033[33m'+ "Note: '%s' is read sequentially, in one chunk. Allow a recompressed copy with Index_cache, or use a splittable compression (e.g. bgzip or multi-frame zstd)" %(fname) +'\033[m')
+
+        if index['copy']:
+            self.target = index['copy']
+            self.codec = CODECS[0]
+            INDEX_COPIES_USED.add(index['copy'])
+            try:
+                os.utime(index['copy'])     # the least recently used copies are removed first
+            except OSError:
+                pass
+        self.points = index['points']
+        self.offsets = index['offsets']
+        self.size = index['size']
+        self.sequential = sparsePoints(self.points, self.size)
+
+
+    def read(self, start, size):
+        """Returns up to 'size' bytes of uncompressed data from 'start'.
+        """
+        with self.open(start) as stream:
+            return stream.read(size)
+
+    @contextmanager
+    def open(self, start):
+        """Context manager giving a binary stream of the uncompressed data from 'start'.
+        """
+        k = bisect_right(self.points, start) - 1
+        with open(self.target, 'rb') as f:
+            f.seek(self.offsets[k])
+            stream = self.codec.open(f)
+            try:
+                skip = start - self.points[k]
+                while skip > 0:
+                    data = stream.read(min(skip, RECORD_BUFFER_SIZE))
+                    if not data:
+                        break
+                    skip -= len(data)
+                yield stream
+            finally:
+                stream.close()
+
+
+def sparsePoints(points, size):
+    '''
+    Tells if the access points of a compressed file are too far apart for its chunks to start at them
+    (more than two INDEX_SPAN of uncompressed data between two of them, or to the end of the data).
+    '''
+    gaps = [b - a for a, b in zip(points, points[1:] + [size])]
+    return not points or max(gaps) > 2*INDEX_SPAN
+
+
+def trimIndexCache(room=0):
+    '''
+    Removes the least recently used recompressed copies in INDEX_CACHE_DIR, along with their indexes,
+    until the copies and 'room' more bytes take at most INDEX_COPY_LIMIT bytes. The copies used by this
+    run are not removed. Returns True if the room was made.
+    '''
+    copies = []
+    for path in glob.glob(os.path.join(INDEX_CACHE_DIR, '*.gz')):
+        try:
+            status = os.stat(path)
+        except OSError:
+            continue
+        copies.append((status.st_mtime, status.st_size, path))
+
+    total = sum(size for mtime, size, path in copies) + room
+    for mtime, size, path in sorted(copies):
+        if total <= INDEX_COPY_LIMIT:
+            break
+        if path in INDEX_COPIES_USED:
+            continue
+        for old in (path, path[:-len('.gz')] + '.idx'):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        total -= size
+    return total <= INDEX_COPY_LIMIT
+
+
+def bgzfBlocks(fname):
+    '''
+    Walks the blocks of a BGZF file (gzip members with a 'BC' extra subfield holding the block size),
+    reading only their headers and trailers. Returns a tuple (points, offsets, size) with the uncompressed
+    and compressed offsets of the blocks and the uncompressed size, or None if the file is not BGZF.
+    '''
+    points = []
+    offsets = []
+    size = os.path.getsize(fname)
+    uoffset = 0
+    coffset = 0
+    with open(fname, 'rb') as f:
+        while coffset < size:
+            f.seek(coffset)
+            header = f.read(12)
+            if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+                return None
+            extra = f.read(int.from_bytes(header[10:12], 'little'))
+            bsize = None
+            i = 0
+            while i + 4 <= len(extra):
+                slen = int.from_bytes(extra[i+2:i+4], 'little')
+                if extra[i:i+2] == b'BC' and slen == 2:
+                    bsize = int.from_bytes(extra[i+4:i+6], 'little')
+                i += 4 + slen
+            if bsize is None or coffset + bsize + 1 > size:
+                return None
+            f.seek(coffset + bsize + 1 - 4)
+            points.append(uoffset)
+            offsets.append(coffset)
+            uoffset += int.from_bytes(f.read(4), 'little')     # ISIZE
+            coffset += bsize + 1
+
+    if not points:
+        return None
+    return points, offsets, uoffset
+
+
+def zstdSeekTable(fname):
+    '''
+    Reads the seek table of a seekable zstd file (a skippable frame at the end of the file with the
+    compressed and decompressed size of every frame). Returns a tuple (points, offsets, size) with the
+    uncompressed and compressed offsets of the frames and the uncompressed size, or None if the file
+    has no seek table.
+    '''
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        if size < 17:
+            return None
+        f.seek(size - 9)
+        footer = f.read(9)
+        if footer[5:] != b'\xb1\xea\x92\x8f':        # seekable magic number
+            return None
+        nframes = int.from_bytes(footer[:4], 'little')
+        entry = 12 if footer[4] & 0x80 else 8     # entries with checksums
+        table = 8 + nframes*entry + 9
+        if table > size:
+            return None
+        f.seek(size - table)
+        header = f.read(8)
+        if header[:4] != b'\x5e\x2a\x4d\x18' or int.from_bytes(header[4:], 'little') != table - 8:
+            return None
+        entries = f.read(nframes*entry)
+
+    points = []
+    offsets = []
+    uoffset = 0
+    coffset = 0
+    for i in range(0, len(entries), entry):
+        points.append(uoffset)
+        offsets.append(coffset)
+        coffset += int.from_bytes(entries[i:i+4], 'little')
+        uoffset += int.from_bytes(entries[i+4:i+8], 'little')
+
+    if not points or coffset != size - table:
+        return None
+    return points, offsets, uoffset
+
+
+def buildIndex(fname, codec, copy_path=None):
+    '''
+    Decompresses a compressed file once, finding the start of its frames. If a copy_path is given, the data
+    is recompressed there at the same time, as one gzip member every INDEX_SPAN bytes; the copy is kept only
+    if the frames of the file are too far apart to be used as access points, and it is given up as soon as
+    it takes more than INDEX_COPY_LIMIT bytes (or room can not be made for it in the cache). Returns the
+    index as a dictionary:
+    {'copy': path of the copy or None, 'points': uncompressed offsets, 'offsets': compressed offsets,
+     'size': uncompressed size}.
+    '''
+    points = []
+    offsets = []
+    copy_points = []
+    copy_offsets = []
+    pending = b''           # decompressed data not copied yet
+    copied = 0              # decompressed data already copied
+    uoffset = 0
+    coffset = 0
+    decompressor = None
+
+    copy = None
+    if copy_path:
+        if not os.path.isdir(os.path.dirname(copy_path)):
+            os.makedirs(os.path.dirname(copy_path))
+        copy = open(copy_path + '.tmp', 'wb')
+
+    with open(fname, 'rb') as f:
+        data = f.read(1 << 20)
+        while data:
+            if decompressor is None:
+                frame = data.lstrip(b'\x00')       # padding between or after frames
+                coffset += len(data) - len(frame)
+                data = frame
+                if not data:
+                    data = f.read(1 << 20)
+                    continue
+                decompressor = codec.decompressor()
+                points.append(uoffset)
+                offsets.append(coffset)
+            out = decompressor.decompress(data)
+            consumed = len(data) - len(decompressor.unused_data)
+            coffset += consumed
+            uoffset += len(out)
+            if copy is not None:
+                pending += out
+            while copy is not None and len(pending) >= INDEX_SPAN:
+                copy_points.append(copied)
+                copy_offsets.append(copy.tell())
+                copy.write(gzip.compress(pending[:INDEX_SPAN], compresslevel=1))
+                copied += INDEX_SPAN
+                pending = pending[INDEX_SPAN:]
+                if copy.tell() > INDEX_COPY_LIMIT:     # the copy does not fit in the cache
+                    copy.close()
+                    os.remove(copy_path + '.tmp')
+                    copy = None
+                    pending = b''
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = None
+            else:
+                data = f.read(1 << 20)
+        if decompressor is not None:
+            if copy is not None:
+                copy.close()
+                os.remove(copy_path + '.tmp')
+            raise IOError("Compressed file ended before the end-of-stream marker was reached: %s" %(fname))
+        if copy is not None and (pending or not copy_points):
+            copy_points.append(copied)
+            copy_offsets.append(copy.tell())
+            copy.write(gzip.compress(pending, compresslevel=1))
+
+    # Frames of the file itself are used if they are not much farther apart than the copy members
+    if copy is not None:
+        copy.close()
+        if not sparsePoints(points, uoffset) or not trimIndexCache(os.path.getsize(copy_path + '.tmp')):
+            os.remove(copy_path + '.tmp')
+            copy = None
+    if copy is None:
+        return {'copy': None, 'points': points, 'offsets': offsets, 'size': uoffset}
+
+    os.replace(copy_path + '.tmp', copy_path)
+    return {'copy': copy_path, 'points': copy_points, 'offsets': copy_offsets, 'size': uoffset}
+
+
+MADV_DONTNEED = getattr(mmap, 'MADV_DONTNEED', None)     # not available on every platform
+
+
+class BoundedStream(object):
+    """Binary stream giving at most 'size' bytes of another stream.
+
+    Class Attributes:
+        stream -- Underlying binary stream.
+        remain -- Bytes that can still be read.
+    """
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remain = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remain:
+            size = self.remain
+        data = self.stream.read(size)
+        self.remain -= len(data)
+        return data
+
+
+#-----------------------------------------------------------------------
+# DataFile Class
+#-----------------------------------------------------------------------
+
+class DataFile(object):
+    """Data file read by byte offsets.
+
+    Plain files are memory-mapped: chunk boundaries are searched and records
+    are split in place on the mapped buffer, so only the bytes of each record
+    are copied. Compressed files can not be mapped, so the requested window
+    of the uncompressed data is decompressed instead, starting from the
+    closest access point of the CompressedIndex of the file.
+
+    Records are read through a buffer of RECORD_BUFFER_SIZE bytes: the pages
+    of the mapping already split are released as the reading goes on, and
+    compressed data is decompressed a buffer at a time, so the memory used by a
+    process does not grow with the size of its chunk.
+
+    Class Attributes:
+        fname  -- Path of the file.
+        file   -- Underlying binary file object (None for compressed files).
+        buffer -- mmap object of the file (None for compressed or empty files).
+        index  -- CompressedIndex of the file (None for plain files).
+        size   -- Size of the (uncompressed) data.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.buffer = None
+        self.index = None
+        codec = detectCodec(fname)
+        if codec is not None:
+            self.index = CompressedIndex(fname, codec)
+            self.file = None
+            self.size = self.index.size
+        else:
+            self.file = open(fname, 'rb')
+            self.size = os.fstat(self.file.fileno()).st_size
+            if self.size:
+                self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def window(self, start, size):
+        """Returns a tuple (buffer, low, high): a buffer supporting find(), rfind()
+        and slicing, and the positions in it of the 'size' bytes from 'start'.
+        """
+        if self.buffer is not None:
+            return self.buffer, min(start, len(self.buffer)), min(start + size, len(self.buffer))
+        if self.index is not None:
+            data = self.index.read(start, size)
+            return data, 0, len(data)
+        return b'', 0, 0
+
+    def records(self, start, size, separator):
+        """Yields the records (as bytes) in the 'size' bytes from 'start',
+        split by separator.
+        """
+        if self.index is not None:
+            with self.index.open(start) as stream:
+                for offset, record in readRecords(BoundedStream(stream, size), separator, start):
+                    yield record
+            return
+
+        buffer, low, high = self.window(start, size)
+        separator = separator.encode()
+        release = low - low % mmap.PAGESIZE     # start of the mapped pages not released yet
+        while low < high:
+            end = buffer.find(separator, low, high)
+            if end == -1:
+                yield buffer[low:high]
+                break
+            yield buffer[low:end]
+            low = end + len(separator)
+            if low - release >= RECORD_BUFFER_SIZE and MADV_DONTNEED is not None:
+                done = low - low % mmap.PAGESIZE
+                buffer.madvise(MADV_DONTNEED, release, done - release)
+                release = done
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.file is not None:
+            self.file.close()
+
+
+# Data files opened by this process, reused by the chunks of the same file
+DATA_FILES = OrderedDict()     # open DataFile objects of this process, least recently used first
+DATA_FILES_MAX = 16             # open data files kept by a process (each one holds a file descriptor)
+
+
+def openData(fname):
+    '''
+    Returns the DataFile object of a file, opening (and mapping) it only the first time it is
+    requested by this process. Only the DATA_FILES_MAX files used last are kept open, as the
+    processes of the pool live for the whole run.
+    '''
+    if fname in DATA_FILES:
+        DATA_FILES.move_to_end(fname)
+    else:
+        while len(DATA_FILES) >= DATA_FILES_MAX:
+            DATA_FILES.popitem(last=False)[1].close()
+        DATA_FILES[fname] = DataFile(fname)
+    return DATA_FILES[fname]
+
+
+def closeData():
+    '''
+    Closes the data files opened by this process.
+    '''
+    for fname in list(DATA_FILES):
+        DATA_FILES.pop(fname).close()
+
+
+FRAG_MIN_SIZE = 1 << 16     # bytes of data below which a file is not worth another process
+FRAG_TAIL = 1 << 16         # bytes at the end of a chunk searched first for its last separator
+
+
+def chunkSize(remain, config):
+    '''
+    Returns the size of the chunks of a file given to the processes: min(remain, max_chunk) / Ncores,
+    but not below FRAG_MIN_SIZE, and no more than the share of the Memory size of a process, if Memory
+    is defined.
+    '''
+    size = (min(remain, config['Csize']) + config['Cores'] - 1) // config['Cores']     # rounded up
+    size = max(size, FRAG_MIN_SIZE)
+    if config['Psize']:
+        size = min(size, config['Psize'])
+    return size
+
+
 def frag(fname, init, separator, size, max_chunk):
     '''
-    Function to fragment files in chunks to be parallel processed for structured files by lines
+    Function to fragment files in chunks to be parallel processed for structured files by lines.
+    Chunks are given as (start, size) in bytes, and end at a record separator. Compressed files read
+    sequentially (see CompressedIndex) are given as one chunk.
     '''
     #print ("File pos: %d, size: %d, max_chunk: %d", init, size, max_chunk)
     
+    data = DataFile(fname)
     try:
-        if fname.endswith('.gz'):                    
-            f = gzip.open(fname, 'r', newline="")
-        else:
-            f = open(fname, 'r', newline="")
-
-
-        f.seek(init)
-        end = f.tell()
-        init = end
-        separator_size = len(separator)
+        if data.index is not None and data.index.sequential:
+            yield init, data.size - init
+            return
+        end = init
+        separator = separator.encode()
         while end-init < max_chunk:
             start = end
-            tmp = f.read(size)
-            i = tmp.rfind(separator)
+            # Only the end of the chunk is read to find its last separator, unless there is none there
+            tail = max(0, min(size, data.size - start) - FRAG_TAIL)
+            buffer, low, high = data.window(start + tail, size - tail)
+            i = buffer.rfind(separator, low, high)
+            if i == -1 and tail:
+                tail = 0
+                buffer, low, high = data.window(start, size)
+                i = buffer.rfind(separator, low, high)
             if i == -1:
-                yield start, len(tmp)
+                yield start, high-low
                 break
-            f.seek(start+i+separator_size)
-            end = f.tell()
+            end = start + tail + (i-low) + len(separator)
             #print("Frag: "+str([start, i, end]))
 
             yield start, end-start
 
     finally:
-        f.close()        
+        data.close()
         
  
-def iter_split(line, delimiter):
-    start = 0
-    line_size = len(line)
-    delimiter_size = len(delimiter)
-    while start<line_size:
-        end = line.find(delimiter, start)
-        yield line[start:end]
-        if end == -1: break
-        start = end + delimiter_size
+def dataSize(fname):
+    '''
+    Returns the size in bytes of the data in a file: the file size from os.stat, or the uncompressed
+    size for compressed files (from their index).
+    '''
+    if detectCodec(fname) is not None:
+        return openData(fname).index.size
+    return os.stat(fname).st_size
+
+
+def countRecords(fname, separator):
+    '''
+    Fast count of the records of a file, as split by DataFile.records(): separators are counted on
+    raw bytes, block by block. Only used when the number of entries is wanted before parsing, since
+    the workers count them during the parse anyway.
+    '''
+    separator = separator.encode()
+    count = 0
+    tail = 0            # bytes after the last separator
+    carry = b''         # bytes at the end of the previous block that may start a separator
+    f = openInput(fname)
+    try:
+        block = f.read(1 << 22)
+        while block:
+            data = carry + block
+            matches = data.count(separator)
+            count += matches
+            if matches:
+                # Separators are matched from the left, so a run of overlapping occurrences at the
+                # end (e.g. "\n\n\n") is walked from its first occurrence to find where the last match ends
+                start = data.rfind(separator)
+                prev = data.rfind(separator, max(0, start-len(separator)+1), start+len(separator)-1)
+                while prev != -1:
+                    start = prev
+                    prev = data.rfind(separator, max(0, start-len(separator)+1), start+len(separator)-1)
+                end = start
+                while start != -1:
+                    end = start + len(separator)
+                    start = data.find(separator, end)
+                tail = len(data) - end
+            else:
+                end = 0
+                tail += len(block)
+            carry = data[max(end, len(data)-len(separator)+1):]
+            block = f.read(1 << 22)
+    finally:
+        f.close()
+
+    if tail:
+        count += 1
+    return count
+
+
+RECORD_BUFFER_SIZE = 1 << 20    # bytes read at a time by readRecords
+
+
+def readRecords(stream, separator, offset=0):
+    '''
+    Generator of the records of a binary stream split by separator, which can have several characters
+    (e.g. "\n\n"). Data is read in buffers of RECORD_BUFFER_SIZE bytes; a separator cut by the end of a
+    buffer is found when the next one is read, without scanning the record again. Yields tuples
+    (offset, record) with the byte offset of each record (offset being the position of the stream)
+    and the record as bytes, without the separator.
+    '''
+    if isinstance(separator, str):
+        separator = separator.encode()
+    buffer = bytearray()
+    start = 0       # start of the current record in buffer
+    scan = 0        # position from which the separator is searched
+    while True:
+        end = buffer.find(separator, scan)
+        if end != -1:
+            yield offset, bytes(buffer[start:end])
+            offset += end + len(separator) - start
+            start = scan = end + len(separator)
+            continue
+
+        data = stream.read(RECORD_BUFFER_SIZE)
+        if not data:
+            break
+        del buffer[:start]
+        scan = max(0, len(buffer) - len(separator) + 1)
+        start = 0
+        buffer += data
+
+    if start < len(buffer):
+        yield offset, bytes(buffer[start:])
+
+
+NFDUMP = 'nfdump'           # nfdump command, looked up in the PATH
+NFDUMP_SUMMARY = 3          # lines of the summary at the bottom of the csv output of nfdump
+
+
+def nfdumpRecords(fname):
+    '''
+    Generator of the records (as bytes) of a nfcapd file, converted to csv by nfdump in a subprocess
+    pipe, so they are parsed while nfdump converts the file and nothing is written to disk. The csv
+    header and the summary at the bottom are stripped on the fly.
+    '''
+    process = subprocess.Popen([NFDUMP, '-r', fname, '-o', 'csv'], stdout=subprocess.PIPE)
+    try:
+        records = readRecords(process.stdout, '\n')
+        next(records, None)     # header
+        pending = deque()       # last lines, which may be the summary
+        for offset, record in records:
+            pending.append(record)
+            if len(pending) > NFDUMP_SUMMARY:
+                yield pending.popleft()
+        if process.wait() != 0:
+            print('\033[33m'+ "Warning: nfdump failed converting '%s' (exit status %d)" %(fname, process.returncode) +'\033[m')
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
         
+
+
+#-----------------------------------------------------------------------
+# Output
+#-----------------------------------------------------------------------
+
+OUTPUT_FORMATS = ('text', 'matrix', 'both')
+MATRIX_FILE = 'output.npy'      # int64 matrix of observations: one row per window (and key), one column per feature
+ROWS_FILE = 'rows.npy'          # row index of the matrix: window tag and key of each row
+
+
+def formatRows(matrix):
+    '''
+    Formats the rows of a matrix of counters as lines of comma separated values, the same as
+    ','.join(map(str, row)) + '\n' for each row, but with vectorized operations: the digits of
+    all the values are computed at once, padded to the widest value, and the padding is dropped.
+    Returns a list of strings, one per row.
+
+    matrix -- numpy.ndarray of integers, with two dimensions, or list of rows.
+    '''
+    if not isinstance(matrix, np.ndarray) and len(set(map(len, matrix))) > 1:
+        return [formatRows([row])[0] for row in matrix]     # rows of different lengths
+    matrix = np.asarray(matrix, dtype=np.int64)
+    if not matrix.size or matrix.min() < 0:
+        return [','.join(map(str, row)) + '\n' for row in matrix.tolist()]
+
+    width = len(str(int(matrix.max())))
+    chars = np.empty(matrix.shape + (width + 1,), dtype=np.uint8)
+    digits = np.ones(matrix.shape, dtype=np.int64)      # number of digits of each value
+    rest = matrix.copy()
+    for j in range(width - 1, -1, -1):
+        chars[:, :, j] = rest % 10 + ord('0')
+        rest //= 10
+        digits += rest > 0
+    chars[:, :, width] = ord(',')
+    chars[:, -1, width] = ord('\n')
+
+    valid = np.arange(width + 1) >= (width - digits)[:, :, None]
+    return chars[valid].tobytes().decode().splitlines(True)
+
+
+def writeMatrix(outdir, rows, matrix):
+    '''
+    Writes the observations of a run as a matrix file and its row index, in NumPy format,
+    so they can be loaded memory-mapped (see loadMatrix) without parsing any text.
+
+    outdir -- Output directory.
+    rows   -- List of (window tag, key) of the rows of the matrix. Keys are the values of
+              the aggregation keys joined by commas ('' without keys).
+    matrix -- numpy.ndarray of int64, one row per item of rows.
+    '''
+    width = max([len(key) for window, key in rows] + [1])
+    index = np.array(rows, dtype=[('window', 'U12'), ('key', 'U%d' %(width))])
+    np.save(outdir + MATRIX_FILE, np.asarray(matrix, dtype=np.int64))
+    np.save(outdir + ROWS_FILE, index)
+
+
+def loadMatrix(outdir, mmap_mode='r'):
+    '''
+    Loads the matrix file and the row index written by writeMatrix.
+    Returns a tuple (matrix, rows), memory-mapped by default: rows['window'] and rows['key']
+    are the window tag and the key of each row of the matrix.
+    '''
+    matrix = np.load(outdir + MATRIX_FILE, mmap_mode=mmap_mode)
+    rows = np.load(outdir + ROWS_FILE, mmap_mode=mmap_mode)
+    return matrix, rows
+
+
+STATE_FILE = 'state.npy'            # counters of the incremental state store
+STATE_INDEX = 'state-index.dat'     # append-only index of the rows of the state store
+STATE_SCHEMA = 'state-schema.json'  # keys and features of the rows and columns of the state store
+STATE_MIN_ROWS = 1024               # initial capacity of the state store, in rows
+
+
+class StateStore(object):
+    """Persistent store of the counters merged by incremental runs (Incremental_Output).
+
+    The counters are kept in a memory-mapped int64 matrix, with one row per
+    window and key and one column per feature, and the window tag and key of
+    each row are appended to a text index. A run only updates the rows of its
+    own observations and appends the new ones, so its cost does not grow with
+    the history of previous runs. The matrix has spare rows at the end, and it
+    is reallocated with twice the rows when they run out. The names of the keys
+    and features of the store are recorded when it is created, and runs with
+    other keys or features are refused.
+
+    Class Attributes:
+        outdir   -- Directory of the store files.
+        counters -- Memory-mapped matrix of counters (numpy.memmap).
+        keys     -- List of (window tag, key) of the rows in use, in row order. The key is the
+                    values of the aggregation keys joined by commas, or None without keys.
+        rows     -- Dictionary of row numbers, indexed by (window tag, key).
+        windows  -- Dictionary of the lists of row numbers of each window tag.
+    """
+    def __init__(self, outdir, features, keys):
+        """Class constructor. Opens the store of a directory, or creates an empty one.
+
+        outdir   -- Directory of the store files.
+        features -- List of feature names (columns of the matrix).
+        keys     -- List of the names of the aggregation keys (Keys parameter).
+        """
+        self.outdir = outdir
+        self.keys = []
+        self.rows = {}
+        self.windows = {}
+        nfeatures = len(features)
+
+        schema = {'keys': list(keys), 'features': list(features)}
+        if os.path.isfile(outdir + STATE_SCHEMA):
+            with open(outdir + STATE_SCHEMA, 'r') as f:
+                stored = json.load(f)
+            if stored['keys'] != schema['keys']:
+                print('\033[31m'+ "**CONFIG FILE ERROR** Keys %s differ from the keys %s of the state store in %s. Use another output directory"
+                      %(schema['keys'], stored['keys'], outdir) +'\033[m')
+                exit(1)
+            if stored['features'] != schema['features']:
+                differ = [i for i in range(min(nfeatures, len(stored['features']))) if stored['features'][i] != schema['features'][i]]
+                print('\033[31m'+ "**CONFIG FILE ERROR** Features differ from the ones of the state store in %s (%d configured, %d stored%s). Use another output directory"
+                      %(outdir, nfeatures, len(stored['features']),
+                        ", feature %d is '%s' instead of '%s'" %(differ[0] + 1, schema['features'][differ[0]], stored['features'][differ[0]]) if differ else '') +'\033[m')
+                exit(1)
+        else:
+            if os.path.isfile(outdir + STATE_INDEX):
+                print('\033[33m'+ "**STATE STORE WARNING** The keys and features of the state store in %s are not recorded, the configured ones are assumed" %(outdir) +'\033[m')
+            elif glob.glob(outdir + 'output-*.dat'):
+                print('\033[33m'+ "**STATE STORE WARNING** %s has output files but no state store: their counters are not merged with the ones of this run" %(outdir) +'\033[m')
+            with open(outdir + STATE_SCHEMA, 'w') as f:
+                json.dump(schema, f)
+
+        if os.path.isfile(outdir + STATE_INDEX):
+            with open(outdir + STATE_INDEX, 'r') as f:
+                for line in f:
+                    tag, sep, key = line.rstrip('\n').partition(',')
+                    self.index((tag, key if sep else None))
+
+        if os.path.isfile(outdir + STATE_FILE):
+            self.counters = np.lib.format.open_memmap(outdir + STATE_FILE, mode='r+')
+            if self.counters.shape[1] != nfeatures or self.counters.shape[0] < len(self.keys):
+                print('\033[31m'+ "**STATE STORE ERROR** '%s' has %d features and %d rows, while %d features are configured and %d rows are indexed"
+                      %(outdir + STATE_FILE, self.counters.shape[1], self.counters.shape[0], nfeatures, len(self.keys)) +'\033[m')
+                exit(1)
+        else:
+            self.counters = np.lib.format.open_memmap(outdir + STATE_FILE, mode='w+', dtype=np.int64, shape=(STATE_MIN_ROWS, nfeatures))
+
+    def index(self, key):
+        """Adds a row to the index of the store and returns its number.
+        """
+        row = len(self.keys)
+        self.keys.append(key)
+        self.rows[key] = row
+        self.windows.setdefault(key[0], []).append(row)
+        return row
+
+    def grow(self, nrows):
+        """Reallocates the matrix of counters if it has less than nrows rows.
+        """
+        capacity, nfeatures = self.counters.shape
+        if nrows <= capacity:
+            return
+        capacity = max(nrows, 2 * capacity)
+        temp = self.outdir + STATE_FILE + '.tmp'
+        counters = np.lib.format.open_memmap(temp, mode='w+', dtype=np.int64, shape=(capacity, nfeatures))
+        counters[:len(self.keys)] = self.counters[:len(self.keys)]
+        counters.flush()
+        del counters
+        del self.counters
+        os.replace(temp, self.outdir + STATE_FILE)
+        self.counters = np.lib.format.open_memmap(self.outdir + STATE_FILE, mode='r+')
+
+    def merge(self, output, window):
+        """Adds the observations of a run to the store.
+        Returns the set of window tags of the observations.
+
+        output -- Dictionary of Observation objects, indexed by window id or by tuples
+                  (window id, key values), as returned by the parser.
+        window -- Sampling window length, in minutes.
+        """
+        tags = {}
+        old_rows, old_data = [], []
+        new_keys, new_data = [], []
+        for k in output:
+            wid = k[0] if isinstance(k, tuple) else k
+            if wid not in tags:
+                tags[wid] = windowTag(wid, window)
+            key = (tags[wid], ','.join(map(str.strip, k[1:])) if isinstance(k, tuple) else None)
+            data = output[k].data
+            if len(data) != self.counters.shape[1]:
+                data = np.pad(data[:self.counters.shape[1]], (0, max(0, self.counters.shape[1] - len(data))))
+            if key in self.rows:
+                old_rows.append(self.rows[key])
+                old_data.append(data)
+            else:
+                new_keys.append(key)
+                new_data.append(data)
+
+        if old_rows:
+            self.counters[old_rows] += np.array(old_data)
+
+        # New rows are written before they are indexed, so an interrupted run leaves them unused
+        if new_keys:
+            start = len(self.keys)
+            self.grow(start + len(new_keys))
+            self.counters[start:start + len(new_keys)] = np.array(new_data)
+        self.counters.flush()
+        if new_keys:
+            with open(self.outdir + STATE_INDEX, 'a') as f:
+                for key in new_keys:
+                    self.index(key)
+                    f.write(key[0] + ('' if key[1] is None else ',' + key[1]) + '\n')
+
+        return set(tags.values())
+
+    def window(self, tag):
+        """Returns the rows of a window, sorted by key: a tuple (keys, counters) with the list
+        of keys and the matrix of their counters.
+        """
+        rows = sorted(self.windows.get(tag, []), key=lambda row: self.keys[row][1] or '')
+        return [self.keys[row][1] for row in rows], self.counters[rows]
+
+    def close(self):
+        """Flushes the counters to disk and closes the store.
+        """
+        self.counters.flush()
+        del self.counters
@@ -13,14 +13,11 @@ Last Modification: 24/Oct/2022
 
 import multiprocessing as mp
 import argparse
-import os
-import gzip
+import io
 import re
 import time
 import faac
-import math
-from datetime import datetime 
-import linecache
+from datetime import datetime, timedelta
 from sys import version_info
 
 
@@ -49,6 +46,10 @@ def main(call='external', configfile=''):
     count_tots = 0          # total structured logs
     count_totu = 0          # total unstructured logs
     
+    # One pool of processes for every file and data source, created once for the whole run.
+    # The configuration is shipped once to each process, so tasks only carry the chunk to process
+    pool = None if debugmode else mp.Pool(config['Cores'], initializer=init_worker, initargs=(config, deparsInput))
+
     # Iterate through features and timestamps
     if deparsInput['features']:
         for source in config['SOURCES']:
@@ -57,22 +58,26 @@ def main(call='external', configfile=''):
                 print("\nLoading '%s' data source..." %(source))
             
             sourcepath = config['SOURCES'][source]['FILESDEP']
-            formated_timestamps = format_timestamps(deparsInput['timestamps'], config['TSFORMAT'][source])
             
             # Structured sources
             if config['STRUCTURED'][source]:
-                (cs, ct) = stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps)
+                (cs, ct) = stru_deparsing(config, sourcepath, deparsInput, source, pool)
                 count_structured += cs
                 count_tots += ct
 
             # Unstructured sources
             else:
+                formated_timestamps = format_timestamps(deparsInput['timestamps'], config['TSFORMAT'][source])
                 (cu, ct) = unstr_deparsing(config, sourcepath, deparsInput,source, formated_timestamps)
                 count_unstructured += cu
                 count_totu += ct
 
             print ("Elapsed: %s" %(prettyTime(time.time() - startTime)))
 
+    if pool:
+        pool.close()
+        pool.join()
+
     if not debugmode:
         stats(count_structured, count_tots, count_unstructured, count_totu, config['OUTDIR'], config['OUTSTATS'], startTime)
 
@@ -104,9 +109,11 @@ def print_loadSummary(config,deparsInput,startTime):
     print ("\n------------------------------------------------------------------------\n")
 
 
-def stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps):
+def stru_deparsing(config, sourcepath, deparsInput, source, pool):
     '''
-    Deparsing process for structured data sources like csv.
+    Deparsing process for structured data sources like csv. The chunks of all the files are
+    submitted to the pool before their results are gathered, so a small file does not leave
+    the processes idle.
     '''
     threshold = config['threshold']
     OUTDIR = config['OUTDIR']
@@ -128,54 +135,40 @@ def stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps)
         except:
             print ("Configuration file error: missing variables")
             exit(1)
-            
-    selection = []  # indices of features in config file matching depars_features
-    for i in range(len(config['FEATURES'][source])):
-        if config['FEATURES'][source][i]['name'] in depars_features:
-            selection.append(i)
-
-    FEATURES_sel = []   # all feature fields for features in depars_features
-    for i in selection:
-        FEATURES_sel.append(config['FEATURES'][source][i])
-            
-    timestamp_pos = VARIABLES[config['TIMEARG'][source]]['where']   # position (column) of timestamp field
 
 
     count_structured = 0    # structured logs found during deparsing process
     count_tot = 0           # total logs
     feat_appear = {}
     feat_appear_names = {}    
+    nlines = {}
+    jobs = {}
+    plan = stru_plan(config, deparsInput, source) if debugmode else None     # built by each process of the pool otherwise
     
-    for file in sourcepath:
+    for file_id, file in enumerate(sourcepath):
         feat_appear[file] = []
         feat_appear_names[file] = []
+        nlines[file] = 0
+        jobs[file] = list()
         
-        if file.endswith('.gz'):
-            input_file = gzip.open(file,'r')
-        else:
-            input_file = open(file,'r')
-
         if debugmode:
             faac.debugProgram('fcdeparser.load_message', [file])
 
         # Multiprocessing
-        pool = mp.Pool(config['Cores'])
         cont = True
         init = 0
-        length = os.path.getsize(file) 
+        length = faac.dataSize(file)
         remain = length
-        while cont:                          # cleans memory from processes
-            nline=0
-            jobs = list()
+        while cont:
             # Initially, data is split into chunks with size: min(filesize, max_chunk) / Ncores
-            for fragStart,fragSize in faac.frag(file,init,config['RECORD_SEPARATOR'][source], int(math.ceil(float(min(remain,config['Csize']))/config['Cores'])), config['Csize']):
+            for fragStart,fragSize in faac.frag(file,init,config['RECORD_SEPARATOR'][source], faac.chunkSize(remain, config), config['Csize']):
                 if not debugmode:
-                    jobs.append( pool.apply_async(process_file,[file,fragStart,fragSize,config,source,timestamp_pos,formated_timestamps,FEATURES_sel,VARIABLES]) )
+                    jobs[file].append( pool.apply_async(process_chunk,[source,file_id,fragStart,fragSize]) )
                 else:
-                    feat_appear_f, feat_appear_names_f, nline_f = process_file(file,fragStart,fragSize,config,source,timestamp_pos,formated_timestamps,FEATURES_sel,VARIABLES)
+                    feat_appear_f, feat_appear_names_f, nline_f = process_file(file,fragStart,fragSize,config,source,*plan)
                     feat_appear[file].extend(feat_appear_f)
                     feat_appear_names[file].extend(feat_appear_names_f)
-                    nline+=nline_f
+                    nlines[file]+=nline_f
                 
             else:
                 if fragStart+fragSize < length:
@@ -191,22 +184,22 @@ def stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps)
                         remain = length
                         global user_input; user_input = None
 
-                            
-            for job in jobs:
-                job_data = job.get()
-                feat_appear_f = job_data[0]
-                feat_appear_names_f = job_data[1]
-                nline_f = job_data[2]
-                feat_appear[file].extend(feat_appear_f)
-                feat_appear_names[file].extend(feat_appear_names_f)
-                nline+=nline_f
+    # Results are gathered in the order of the chunks, as they are indexed by line position
+    for file in sourcepath:
+        for job in jobs[file]:
+            job_data = job.get()
+            feat_appear_f = job_data[0]
+            feat_appear_names_f = job_data[1]
+            nline_f = job_data[2]
+            feat_appear[file].extend(feat_appear_f)
+            feat_appear_names[file].extend(feat_appear_names_f)
+            nlines[file]+=nline_f
                     
-                
-        input_file.close()
-        count_tot+=nline    # add nlines of this source to total lines counter
+
+        count_tot+=nlines[file]    # add nlines of this source to total lines counter
         
         # Print number of matched logs for each features number (feature selection criteria)
-        matched_lines = faac.debugProgram('fcdeparser.stru_deparsing.feat_appear', [feat_appear[file], depars_features, nline])
+        matched_lines = faac.debugProgram('fcdeparser.stru_deparsing.feat_appear', [feat_appear[file], depars_features, nlines[file]])
     
     
     # Obtain number of features needed to extract the log with the given threshold
@@ -239,21 +232,27 @@ def stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps)
     # Re-read the file extracting the raw data
     for file in sourcepath:
         
-        if file.endswith('.gz'):
-            input_file = gzip.open(file,'r')
-        else:
-            input_file = open(file,'r')
-        
+        input_file = io.TextIOWrapper(faac.openInput(file))
         
         if not debugmode:
+            # Lines to extract, with their number of features, found in a single pass over the file
+            selected = {}
+            output_files = {}
             for nfeatures in indices[file]:
                 if indices[file][nfeatures]:
-                    output_file = open(OUTDIR + "output_%s_%sfeat" %(source,nfeatures),'a')
+                    output_files[nfeatures] = open(OUTDIR + "output_%s_%sfeat" %(source,nfeatures),'a')
                     for line_index in indices[file][nfeatures]:
-                        line = linecache.getline(file, line_index+1) # index starting by 1 with linecache function
-                        output_file.write(line)
-                        count_structured += 1
-                    output_file.close()
+                        selected[line_index] = nfeatures
+
+            for position, line in enumerate(input_file):
+                if position in selected:
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    output_files[selected[position]].write(line)
+                    count_structured += 1
+
+            for output_file in output_files.values():
+                output_file.close()
                 
         else:
             for position, line in enumerate(input_file):
@@ -269,36 +268,75 @@ def stru_deparsing(config, sourcepath, deparsInput, source, formated_timestamps)
 
     return (count_structured, count_tot)
 
-def process_file(file, fragStart, fragSize, config, source, timestamp_pos, formated_timestamps, FEATURES_sel, VARIABLES):
+def stru_plan(config, deparsInput, source):
+    '''
+    Returns what is needed to find the features in the logs of a structured source: the position of the
+    timestamp field, the formatted timestamps, the plan of the selected features and the variables by name.
+    '''
+    depars_features = deparsInput['features']
+    VARIABLES = {}
+    for variable in config['SOURCES'][source]['CONFIG']['VARIABLES']:
+        VARIABLES[variable['name']] = variable
+            
+    selection = []  # indices of features in config file matching depars_features
+    for i in range(len(config['FEATURES'][source])):
+        if config['FEATURES'][source][i]['name'] in depars_features:
+            selection.append(i)
+
+    FEATURES_sel = []   # all feature fields for features in depars_features
+    for i in selection:
+        FEATURES_sel.append(config['FEATURES'][source][i])
+    PLAN_sel = faac.FeaturePlan(FEATURES_sel, config['SOURCES'][source]['CONFIG']['VARIABLES'], config['TSFORMAT'][source])
+            
+    timestamp_pos = VARIABLES[config['TIMEARG'][source]]['where']   # position (column) of timestamp field
+    formated_timestamps = format_timestamps(deparsInput['timestamps'], config['TSFORMAT'][source])
+
+    return timestamp_pos, formated_timestamps, PLAN_sel, VARIABLES
+
+
+def init_worker(config, deparsInput):
+    '''
+    Initializer of the processes of the pool. The configuration and the deparsing input are received
+    once by each process and kept for all the chunks it is given, as are the plans of the sources.
+    '''
+    global worker_config; worker_config = config
+    global worker_input; worker_input = deparsInput
+    global worker_plans; worker_plans = {}
+
+
+def process_chunk(source, file_id, fragStart, fragSize):
+    '''
+    Task of the pool of processes: finds the features in a chunk of a file, given by the data source and
+    the index of the file in it, with the configuration received by the process when it was created.
+    '''
+    if source not in worker_plans:
+        worker_plans[source] = stru_plan(worker_config, worker_input, source)
+    file = worker_config['SOURCES'][source]['FILESDEP'][file_id]
+    return process_file(file, fragStart, fragSize, worker_config, source, *worker_plans[source])
+
+
+def process_file(file, fragStart, fragSize, config, source, timestamp_pos, formated_timestamps, PLAN_sel, VARIABLES):
     
     feat_appear = []
     feat_appear_names = []
     separator = config['RECORD_SEPARATOR'][source]
+    VARIABLES_sel = faac.selectVariables(config['SOURCES'][source]['CONFIG']['VARIABLES'], set(PLAN_sel.variables))     # only variables of the selected features are parsed
 
-    try:    
-        if file.endswith('.gz'):                    
-            f = gzip.open(file, 'r', newline="")
-        else:
-            f = open(file, 'r', newline="")
-
-        f.seek(fragStart)
-        lines = f.read(fragSize)
-        #if debugmode: print("[Loaded set of %d logs]\n" %(len(lines.split(separator))))
-            
-    finally:
-        f.close()
+    # Data entries are read from the file by byte offsets, through a fixed-size buffer
+    records = faac.openData(file).records(fragStart, fragSize, separator)
             
         
     nline=0   
-    for line in faac.iter_split(lines, separator):  
+    for line in records:
         nline+=1  
         try:
+            line = line.decode()
             t = getStructuredTime(line, timestamp_pos, config['TSFORMAT'][source])  # timestamp in that line
 
             # extract amount of features that appear in the line if its timestamp is included in formated_timestamps
             if t.strip() in formated_timestamps or not formated_timestamps:
-                record = faac.Record(line,config['SOURCES'][source]['CONFIG']['VARIABLES'], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
-                obs = faac.Observation.fromRecord(record, FEATURES_sel)         # to make default features counter work properly, use config['FEATURES'][source] instead of FEATURES_sel (but execution will be significantly slower)
+                record = faac.Record(line,VARIABLES_sel, config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
+                obs = faac.Observation.fromRecord(record, PLAN_sel)         # to make default features counter work properly, use config['PLAN'][source] instead of PLAN_sel (but execution will be significantly slower)
                 feature_count, matched_features = search_features_str(obs, VARIABLES)
                 feat_appear.append(feature_count)
                 feat_appear_names.append(matched_features)
@@ -333,6 +371,8 @@ def unstr_deparsing(config, sourcepath, deparsInput, source, formated_timestamps
     FEATURES_sel = []   # all feature fields for features in depars_features
     for i in selection:
         FEATURES_sel.append(config['FEATURES'][source][i])
+    PLAN_sel = faac.FeaturePlan(FEATURES_sel, config['SOURCES'][source]['CONFIG']['VARIABLES'], config['TSFORMAT'][source])
+    VARIABLES_sel = faac.selectVariables(config['SOURCES'][source]['CONFIG']['VARIABLES'], set(PLAN_sel.variables))     # only variables of the selected features are parsed
 
     VARIABLES = {}  # all variables from config file
 
@@ -355,65 +395,27 @@ def unstr_deparsing(config, sourcepath, deparsInput, source, formated_timestamps
         for nfeatures in range(len(depars_features),0,-1):
             indices[file][nfeatures] = []   # dict of dicts for each number of features
 
-        if file.endswith('.gz'):
-            input_file = gzip.open(file,'r')
-        else:
-            input_file = open(file,'r')
+        input_file = faac.openInput(file)
             
         if debugmode:
             faac.debugProgram('fcdeparser.load_message', [file])
 
 
         # First read to generate list of number of appearances
-        line = input_file.readline()
-        nline=0
-        log_indices = []
-
-        if line:
-            log = "" 
-            log_indices.append(nline+1)
-            while line:
-                nline+=1
-                log += line 
-    
-                if len(log.split(config['RECORD_SEPARATOR'][source])) > 1:
-                    count_tot+=1
-                    log_indices.append(nline)
-                    logExtract = log.split(config['RECORD_SEPARATOR'][source])[0]
-                    
-                    # For each log, extract timestamp with regular expresions and check if in formated_timestamps
-                    try:
-                        t = getUnstructuredTime(logExtract, VARIABLES[timearg]['where'], config['TSFORMAT'][source])                    
-                        if str(t).strip() in formated_timestamps or not formated_timestamps:    
-                            # Check if features appear in the log in order to write in the file later
-                            record = faac.Record(logExtract,config['SOURCES'][source]['CONFIG']['VARIABLES'], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
-                            obs = faac.Observation.fromRecord(record, FEATURES_sel)
-                            feature_count = sum( [obs.data[i].value for i in range(len(obs.data))] )
-                            feat_appear[file].append(feature_count)
-                            indices[file][feature_count].append(log_indices)
-                    except:
-                        pass
-                        
-                    log = ""
-                    log_indices = [nline+1] # reset log_indices adding first line of next log
-                    for n in logExtract.split(config['RECORD_SEPARATOR'][source])[1::]:
-                        log += n    # if next log in the same line, add remaining part
-                        log_indices = [nline]   # in this case, next log first index is actual line
-                
-                line = input_file.readline()
-
-            # Deal with the last log, not processed during while loop.
-            log += line
-            log_indices.append(nline)
-            try:                                
-                t = getUnstructuredTime(log, VARIABLES[timearg]['where'], config['TSFORMAT'][source])
-                if str(t) in formated_timestamps or not formated_timestamps:
-                    record = faac.Record(logExtract,config['SOURCES'][source]['CONFIG']['VARIABLES'], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
-                    obs = faac.Observation.fromRecord(record, FEATURES_sel)
-                    feature_count = sum( [obs.data[i].value for i in range(len(obs.data))] )
+        for offset, log in faac.readRecords(input_file, config['RECORD_SEPARATOR'][source]):
+            count_tot+=1
+            logExtract = log.decode()
+
+            # For each log, extract timestamp with regular expresions and check if in formated_timestamps
+            try:
+                t = getUnstructuredTime(logExtract, VARIABLES[timearg]['where'], config['TSFORMAT'][source])                    
+                if str(t).strip() in formated_timestamps or not formated_timestamps:    
+                    # Check if features appear in the log in order to write in the file later
+                    record = faac.Record(logExtract,VARIABLES_sel, config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
+                    obs = faac.Observation.fromRecord(record, PLAN_sel)
+                    feature_count = int(obs.data.sum())
                     feat_appear[file].append(feature_count)
-                    indices[file][feature_count].append(log_indices)
-                    
+                    indices[file][feature_count].append((offset, len(log)))    # byte offset and size of the log
             except:
                 pass
 
@@ -446,65 +448,45 @@ def unstr_deparsing(config, sourcepath, deparsInput, source, formated_timestamps
         print("Note that the output will be generated in different files according to their number of features")
         
         
-    #Re-read desired lines
+    #Re-read desired logs
     for file in sourcepath:
-    
-        if file.endswith('.gz'):
-            input_file = gzip.open(file,'r')
-        else:
-            input_file = open(file,'r')  
-            
 
         if not debugmode:
+            data = faac.openData(file)
             for nfeatures in range(len(depars_features),features_threshold,-1):
                 if indices[file][nfeatures]:
                     output_file = open(OUTDIR + "output_%s_%sfeat" %(source,nfeatures),'a')
-                    for line_indices in indices[file][nfeatures]:
-                        log=""
-                        for index in range(line_indices[0], 1+line_indices[1]):
-                            log+=linecache.getline(file, index)
-                        
-                        logExtract = log.split(config['RECORD_SEPARATOR'][source])[0]
-                        if log.split(config['RECORD_SEPARATOR'][source])[1]: 
-                            logExtract = log.split(config['RECORD_SEPARATOR'][source])[1] # if characters after the separator, take them instead
+                    for offset, size in indices[file][nfeatures]:
+                        buffer, low, high = data.window(offset, size)
+                        logExtract = bytes(buffer[low:high]).decode()
                         output_file.write(logExtract + config['RECORD_SEPARATOR'][source])
                         count_unstructured += 1
                     output_file.close()
                 
         else:
+            input_file = faac.openInput(file)
+
             index = 0
             index_deparsed = 0
-            line = input_file.readline()
-                
-            if line:
-                log = ""     
-                while line:
-                    log += line 
-                    if len(log.split(config['RECORD_SEPARATOR'][source])) > 1:
-                        logExtract = log.split(config['RECORD_SEPARATOR'][source])[0]
-                        try:
-                            t = getUnstructuredTime(logExtract, VARIABLES[timearg]['where'], config['TSFORMAT'][source])     
-                            if str(t).strip() in formated_timestamps or not formated_timestamps:
-                                if feat_appear[file][index_deparsed] > features_threshold and opmode in {1,2}:    
-                                    faac.debugProgram('fcdeparser.unstr_deparsing.deparsed_log', [index+1, logExtract, feat_appear[file][index_deparsed], opmode])
-                                elif opmode in {1}:
-                                    faac.debugProgram('fcdeparser.unstr_deparsing.unmatched_criteria1', [index+1, logExtract, feat_appear[file][index_deparsed]])
-                                index_deparsed+=1
-                            elif opmode in {1}:
-                                faac.debugProgram('fcdeparser.unstr_deparsing.unmatched_criteria2', [index+1, logExtract])
-                            index += 1
-                        except SystemExit:
-                            exit(1)
-                        except:
-                            pass
-
-                        log = ""
-                        for n in logExtract.split(config['RECORD_SEPARATOR'][source])[1::]:
-                            log += n
-                    line = input_file.readline()
+            for offset, log in faac.readRecords(input_file, config['RECORD_SEPARATOR'][source]):
+                logExtract = log.decode()
+                try:
+                    t = getUnstructuredTime(logExtract, VARIABLES[timearg]['where'], config['TSFORMAT'][source])     
+                    if str(t).strip() in formated_timestamps or not formated_timestamps:
+                        if feat_appear[file][index_deparsed] > features_threshold and opmode in {1,2}:    
+                            faac.debugProgram('fcdeparser.unstr_deparsing.deparsed_log', [index+1, logExtract, feat_appear[file][index_deparsed], opmode])
+                        elif opmode in {1}:
+                            faac.debugProgram('fcdeparser.unstr_deparsing.unmatched_criteria1', [index+1, logExtract, feat_appear[file][index_deparsed]])
+                        index_deparsed+=1
+                    elif opmode in {1}:
+                        faac.debugProgram('fcdeparser.unstr_deparsing.unmatched_criteria2', [index+1, logExtract])
+                    index += 1
+                except SystemExit:
+                    exit(1)
+                except:
+                    pass
 
-        
-        input_file.close()
+            input_file.close()
     
     return (count_unstructured, count_tot)
 
@@ -573,10 +555,10 @@ def getUnstructuredTime (log, regexp, timestamp_format):
     p = re.search(regexp, log)
     try:
         rawTime = p.group(0)
-        time = datetime.strptime(rawTime, timestamp_format)
+        time = faac.parseTimestamp(rawTime, timestamp_format)
         time = time.replace(second = 00)
         if time.year == 1900:
-            time = time.replace(year = datetime.now().year)      
+            time = time.replace(year = faac.CURRENT_YEAR)      
         
         return time.strftime(timestamp_format)
 
@@ -591,7 +573,7 @@ def getStructuredTime(line, pos, timestamp_format):
 
     valueList = line.split(',')
     rawTime = valueList[pos]
-    time = datetime.strptime(rawTime, timestamp_format)
+    time = faac.parseTimestamp(rawTime, timestamp_format)
     time = time.replace(second = 00)                # ignore seconds
     time = time.replace(microsecond = 00)           # ignore microseconds
     
@@ -648,10 +630,7 @@ def getDeparsInput(deparsfile,config):
             try:
                 for i in range(config['Time']['window'] ):
                     t = datetime.strptime(timestamp,"%Y-%m-%d %H:%M:%S")
-                    new_minute = (t.minute + i) % 60
-                    new_hour = int((t.hour + i/60) % 24)
-                    new_day = int((t.day + i/(24*60)))
-                    t = t.replace(day = new_day, hour = new_hour, minute = new_minute, second = 0)    
+                    t = t.replace(second = 0) + timedelta(minutes = i)      # every minute of the window, across hours and days
                     temp.append(str(t))
             except:
                 print(t)
@@ -712,14 +691,13 @@ def search_features_str(obs, VARIABLES):
     """
     
     matched_features = []
-    feature_count = sum([obs.data[i].value for i in range(len(obs.data))])
+    feature_count = int(obs.data.sum())
     
     if debugmode:
-        obs_value_list = [obs.data[i].value for i in range(len(obs.data))]
-        feature_index = [i for i, j in enumerate(obs_value_list) if j != 0] # matched features index (non zero counters)
+        feature_index = obs.data.nonzero()[0] # matched features index (non zero counters)
         for index in feature_index:
-            fName = obs.data[index].fName
-            fVariable = obs.data[index].fVariable
+            fName = obs.plan.names[index]
+            fVariable = obs.plan.variables[index]
             pos = VARIABLES[fVariable]['where']
             matched_features.append({fName:pos})
     
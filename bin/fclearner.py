@@ -14,14 +14,11 @@ Last Modification: 30/Jul/2022
 
 import multiprocessing as mp
 import argparse
-import gzip
 import re
 import time
 import yaml
 import faac
-import math
-from collections import OrderedDict
-from math import floor
+from collections import OrderedDict, deque
 from sys import version_info
     
 def main(call='external',configfile=''):
@@ -47,8 +44,15 @@ def main(call='external',configfile=''):
     stats = create_stats(config)
     stats = count_entries(config,stats) 
 
-    # Parse
-    output_data = parsing(config, startTime, stats)
+    # Parse, with one pool of processes for every file and data source, created once for the whole run
+    # The configuration is shipped once to each process, so tasks only carry the chunk to process
+    pool = mp.Pool(config['Cores'], initializer=init_worker, initargs=(config, debugmode))
+    try:
+        output_data = parsing(config, startTime, stats, pool)
+    finally:
+        pool.close()
+        pool.join()
+    stats['total_lines'] = sum(stats['lines'].values())
 
     # Filter output => Only filter during processing, not here, so we identify features that at relevant during a certain interval
     output_data = filter_output(output_data, config['EndLperc'], config['Lperc'])
@@ -64,33 +68,36 @@ def main(call='external',configfile=''):
 
 
 
-def parsing(config,startTime,stats):
+def parsing(config,startTime,stats,pool):
     '''
     Main process for parsing. The program is in charge of temporal sampling.
+    The chunks of all files and data sources are scheduled on the same pool, so a small file 
+    does not leave the processes idle.
     '''
     results = {}
+    jobs = deque()      # (source, job) of the partial results not merged yet, oldest first
 
     for source in config['SOURCES']:
-        results[source] = []
+        results[source] = {}
         currentTime = time.time()
         print ("\n-----------------------------------------------------------------------\n")
         print ("Elapsed: %s \n" %(prettyTime(currentTime - startTime)))
 
 
-        results[source] = process_multifile(config, source, stats)
+        process_multifile(config, source, stats, pool, jobs, results)
 
+    while jobs:
+        collect(jobs, results, config, stats)
 
     return results
 
 
-def process_multifile(config, source, stats):
+def process_multifile(config, source, stats, pool, jobs, results):
     '''
-    processing files procedure in offline parsing. In this function the pool 
-    of proccesses is created. Each file is fragmented in chunk sizes that can be load to memory. 
-    Each process is assigned a chunk of file to be processed.
-    The results of each process are gathered to be postprocessed. 
+    processing files procedure in offline parsing. Each file is fragmented in chunk sizes that can 
+    be load to memory. Each chunk is submitted to the pool of processes, and the partial
+    results are merged into the results of the source as they arrive.
     '''
-    results = {}
     count = 0
     lengths = stats['sizes'][source] #filesiz
     
@@ -106,19 +113,14 @@ def process_multifile(config, source, stats):
             #Print some progress stats
             print ("%s  #%s / %s  %s" %(source, str(count), str(len(config['SOURCES'][source]['FILESTRAIN'])), tag))
          
-            # Recalculate Ncores if nlogs < ncores for this datasource
-            ncores_bkp = config['Cores']
-            nlogs = stats['lines'][source]
-            if config['Cores']>1 and 10*config['Cores'] > nlogs:     
-                config['Cores'] = max(1, floor(nlogs/10))
-             
             # Multiprocessing   
-            pool = mp.Pool(config['Cores'])
-            while cont:         # cleans memory from processes
-                jobs = list()
+            while cont:
                 # Initially, data is split into chunks with size: min(filesize, max_chunk) / Ncores
-                for fragStart,fragSize in faac.frag(input_path,init,config['RECORD_SEPARATOR'][source], int(math.ceil(float(min(remain,config['Csize']))/config['Cores'])),config['Csize']):
-                    jobs.append( pool.apply_async(process_file,(input_path,fragStart,fragSize,config, source)) )
+                for fragStart,fragSize in faac.frag(input_path,init,config['RECORD_SEPARATOR'][source], faac.chunkSize(remain, config),config['Csize']):
+                    jobs.append( (source, pool.apply_async(process_chunk,(source,i,fragStart,fragSize))) )
+                    # Partial results are merged as they arrive, so only a few of them are held at a time
+                    if len(jobs) >= 2*config['Cores']:
+                        collect(jobs, results, config, stats)
                 else:
                     if fragStart+fragSize < lengths[i]:
                         remain = lengths[i] - fragStart+fragSize
@@ -126,18 +128,24 @@ def process_multifile(config, source, stats):
                     else:
                         cont = False
 
-                for job in jobs:
-                    job_data = job.get()
-                    processed_lines = job_data[0]
-                    obsDict = job_data[1]
-                    stats['processed_lines'][source] += processed_lines
-                    results = combine(results,obsDict)
 
+def collect(jobs, results, config, stats):
+    '''
+    Function to merge the oldest partial result submitted to the pool into the results of its data source
+    '''
+    source, job = jobs.popleft()
+    results[source] = merge_results(results[source], job.get(), config, source, stats)
+
+def merge_results(results, job_data, config, source, stats):
+    '''
+    Function to add the partial results of a process (processed entries, observations and entries read)
+    to the results and stats of the data source
+    '''
+    stats['processed_lines'][source] += job_data[0]
+    if not config['Count']:
+        stats['lines'][source] += job_data[2]
+    return combine(results, job_data[1])
 
-            pool.close()
-            config['Cores'] = ncores_bkp
-    
-    return results
 
 def combine(results, obsDict):
     '''
@@ -148,40 +156,49 @@ def combine(results, obsDict):
     
     return results 
 
+def init_worker(config, debug):
+    '''
+    Initializer of the processes of the pool. The configuration is received once by each process
+    and kept for all the chunks it is given, along with the caches warmed while parsing them.
+    '''
+    global worker_config; worker_config = config
+    global debugmode; debugmode = debug
+
+
+def process_chunk(source, file_id, fragStart, fragSize):
+    '''
+    Task of the pool of processes: processes a chunk of a file, given by the data source and the
+    index of the file in it, with the configuration received by the process when it was created.
+    '''
+    file = worker_config['SOURCES'][source]['FILESTRAIN'][file_id]
+    return process_file(file, fragStart, fragSize, worker_config, source)
+
+
 def process_file(file, fragStart, fragSize, config, source):
     '''
     Function that uses each process to get data entries from unstructured data using the separator defined
     in configuration files that will be transformed into observations. This is used only in offline parsing. 
+    Returns the number of processed entries, the observations and the number of entries read.
     '''
 
     obsDict = {}
     processed_lines = 0
+    nlogs = 0
     separator = config['RECORD_SEPARATOR'][source]
 
-    try:    
-        if file.endswith('.gz'):                    
-            f = gzip.open(file, 'r', newline="")
-        else:
-            f = open(file, 'r', newline="")
-
-        f.seek(fragStart)
-        lines = f.read(fragSize)
-        #if debugmode: print("[Loaded set of %d logs]\n" %(len(lines.split(separator))))
-            
-    finally:
-        f.close()
+    # Data entries are read from the file by byte offsets, through a fixed-size buffer
+    records = faac.openData(file).records(fragStart, fragSize, separator)
 
-    for line in faac.iter_split(lines, separator):  
+    for line in records:
+        nlogs += 1
+        line = line.decode()
         tag, instances = process_log(line, config, source)
-        
-        if tag == 0:
-            tag = file.split("/")[-1]
 
         if instances is not None:
             aggregate(obsDict, instances, tag)
             processed_lines+=1
             
-    return processed_lines, obsDict
+    return processed_lines, obsDict, nlogs
 
 
 def process_log(log, config, source):
@@ -196,7 +213,7 @@ def process_log(log, config, source):
 
     if not ignore_log:
         
-        record = faac.Record(log,config['SOURCES'][source]['CONFIG']['VARIABLES'], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
+        record = faac.Record(log,config['RECORD_VARIABLES'][source], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
 
         instances = {}
         for variable in range(len(config['SOURCES'][source]['CONFIG']['VARIABLES'])):
@@ -234,8 +251,7 @@ def process_log(log, config, source):
 
         window = config['Time']['window']     
         try:
-            tag2 = normalize_timestamps(log_timestamp, window)
-            tag = tag2.strftime("%Y%m%d%H%M")
+            tag = faac.windowId(log_timestamp, window)
 
         except: 
             # Exception as err
@@ -251,28 +267,6 @@ def process_log(log, config, source):
     return tag, instances
 
 
-def normalize_timestamps(t, window):
-    '''
-    Function that transform timestamps of data entries to a normalized format. It also do the 
-    time sampling using the time window defined in the configuration file.
-    '''    
-    #try:
-    if window == 0:
-        return 0
-    if window <= 60:
-        new_minute = t.minute - t.minute % window  
-        t = t.replace(minute = new_minute, second = 0)
-    elif window <= 1440:
-        window_m = window % 60  # for simplicity, if window > 60 we only use the hours
-        window_h = int((window - window_m) / 60)
-        new_hour = t.hour - t.hour % window_h  
-        t = t.replace(hour = new_hour, minute = 0, second = 0)                 
-    return t
-    #except Exception as err: print("[!] Normalizing error: "+str(err))
-        
-    return 0
-        
-
 def aggregate(obsDict, instances_new, tag):
     '''
     Aggregate counters
@@ -317,55 +311,6 @@ def getTag(filename):
         return None
     
 
-def file_len(fname):
-    '''
-    Function to get lines from a file
-    '''
-    count_log = 0
-    try:
-        if fname.endswith('.gz'):
-            input_file = gzip.open(fname,'r')
-        else:
-            input_file = open(fname,'r')
-
-        for count_log, l in enumerate(input_file):
-            pass
-
-    finally:
-        size = input_file.tell()
-        input_file.close()
-
-    return count_log+1,size
-
-
-def file_uns_len(fname, separator):
-    '''
-    Function determine de number of logs for a unstructured file 
-    '''
-    count_log = 0
-    try:
-        if fname.endswith('.gz'):
-            input_file = gzip.open(fname,'r')
-        else:
-            input_file = open(fname,'r')
-
-        log ="" 
-        for line in input_file:        
-            log += line 
-
-            splitt = log.split(separator);
-            if len(splitt) > 1:
-                count_log += 1    
-                log = log[len(splitt[0])+1:]
-
-    
-    finally:
-        size = input_file.tell()
-        input_file.close()
-
-    return count_log,size 
-
-
 def create_stats(config):
     '''
     Legacy function - To be updated
@@ -384,44 +329,25 @@ def create_stats(config):
 
 def count_entries(config,stats):
     '''
-    Function to get the amount of data entries and bytes for each data source
+    Function to get the amount of bytes for each data source. Files are split by size, so data entries
+    are counted by the processes while they are parsed, unless Count_entries is set in the configuration.
     '''
 
-    lines = {}
+    stats['lines'] = {}
     stats['processed_lines'] = {}
     stats['sizes'] = {}
     for source in config['SOURCES']:
-        lines[source] = 0
+        stats['lines'][source] = 0
         stats['processed_lines'][source] = 0
         stats['sizes'][source] = list()
         for file in config['SOURCES'][source]['FILESTRAIN']:
-            
-            if config['STRUCTURED'][source]:
-                (l,s) = file_len(file)
-                lines[source] += l
-                stats['sizes'][source].append(s)
-                
-            # unstructured source
-            else:
-                (l,s) = file_uns_len(file,config['RECORD_SEPARATOR'][source])
-                lines[source] += l
-                stats['sizes'][source].append(s)
-    
-
-    # Sum lines from all datasources to obtain tota lines.
-    total_lines = 0
-
-    stats['lines'] = {}
-    for source in lines:
-        total_lines += lines[source]
-        stats['lines'][source] = lines[source]
-
-    stats['total_lines'] = total_lines
+            stats['sizes'][source].append(faac.dataSize(file))
+            if config['Count']:
+                stats['lines'][source] += faac.countRecords(file, config['RECORD_SEPARATOR'][source])
 
     return stats
 
 
-           
 def prettyTime(elapsed):
     '''
     Function to format time for print.
@@ -17,18 +17,24 @@ Last Modification: 24/Oct/2021
 import multiprocessing as mp
 import argparse
 import os
-import gzip
+import pickle
 import re
+import shutil
 import time
-from operator import add
 import faac
-import math
-from collections import OrderedDict
-from math import floor
+import nfcapd
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from sys import version_info   
 
+BATCH_SIZE = 10000      # structured data entries parsed together in columnar form
+BATCH_EXPANSION = 8     # bytes of memory used to parse a batch per byte of its data entries
+REDUCE_FANIN = 8        # partial results of a partition of windows merged together by a job of the pool
 
-def main(call='external',configfile=''):
+
+def main(call='external',configfile='',export=False):
 
     startTime = time.time()
 
@@ -37,18 +43,27 @@ def main(call='external',configfile=''):
     if call == 'external':
         args = getArguments()
         configfile = args.config
+        export = args.export
         global debugmode; debugmode = args.debug    # debugmode defined as global as it will be used in many functions
 
     # Get configuration
     print("LOADING GENERAL CONFIGURATION FILE...")
     parserConfig = faac.getConfiguration(configfile)
-    config = faac.loadConfig(parserConfig, 'fcparser', debugmode)
+    config = faac.loadConfig(parserConfig, 'fcparser', debugmode, export)
+    checkNfcapd(config)
+    checkStateStore(config, export or config['Incremental'] and not parserConfig['Online'], export)
     
     # Print configuration summary
     configSummary(config)
 
     # Output Weights
     outputWeight(config)
+
+    # Regenerate the output files from the state store of incremental runs, without parsing
+    if export:
+        export_output(config)
+        print("Elapsed: %s \n" %(prettyTime(time.time() - startTime)))
+        return
     
     # Create stats file and count data entries
     stats = create_stats(config)
@@ -68,7 +83,15 @@ def main(call='external',configfile=''):
             print('\033[33m'+ "Note: Malformed logs or inaccurate data source configuration files will result in None variables which will not be counted in any feature.")
             print("Run program in debug mode with -d option to check how the records are parsed." +'\033[m')
         
-        data = offline_parsing(config, startTime, stats)
+        # One pool of processes for every file and data source, created once for the whole run
+        # The configuration is shipped once to each process, so tasks only carry the chunk to process
+        pool = None if debugmode else mp.Pool(config['Cores'], initializer=init_worker, initargs=(config,))
+        try:
+            data = offline_parsing(config, startTime, stats, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
         output_data = fuseObs_offline(data)
         #with open(config['OUTDIR']+'fused_dict', 'w') as f: print(output_data, file=f) # this output file does not seem to be relevant for the user
         
@@ -82,35 +105,59 @@ def main(call='external',configfile=''):
 
 
 
-def offline_parsing(config,startTime,stats):
+def offline_parsing(config,startTime,stats,pool):
     '''
     Main process for offline parsing. In this case, the program is in charge of temporal sampling.
     Also, it is multiprocess for processing large files faster. Number of cores used and chunk sizes
-    to divide files for the different processes. 
+    to divide files for the different processes. The chunks of all files and data sources are
+    scheduled on the same pool, so a small file does not leave the processes idle.
+    The partial results are split by windows into one partition per process, and they are merged
+    by the pool as well, in a tree, so the merging of the results also scales with the processes.
     '''
     results = {}
+    jobs = deque()      # (source, partition, job) of the jobs not gathered yet, oldest first (partition is None for parsing jobs)
+    partials = {}       # pickled partial results waiting to be merged, by source and partition
 
     for source in config['SOURCES']:
-        results[source] = []
+        results[source] = faac.Counters(len(config['PLAN'][source].names))
+        partials[source] = [list() for part in range(config['Cores'])]
         currentTime = time.time()
         if not debugmode:
             print("\n-----------------------------------------------------------------------\n")
             print("Elapsed: %s \n" %(prettyTime(currentTime - startTime)))    
             
-        results[source] = process_multifile(config, source, stats) 
-
+        process_multifile(config, source, stats, pool, jobs, partials)
+
+    while jobs:
+        collect(jobs, partials, config, stats, pool)
+
+    # Last level of the tree: the results left of each partition are merged into one
+    for source in partials:
+        for part in range(len(partials[source])):
+            if len(partials[source][part]) > 1:
+                jobs.append( (source, part, pool.apply_async(reduce_partials,[partials[source][part]])) )
+                partials[source][part] = list()
+    while jobs:
+        collect(jobs, partials, config, stats, pool)
+
+    # Partitions hold different windows, so their results are just put together
+    for source in partials:
+        for part in partials[source]:
+            for blob in part:
+                results[source] = combine(results[source], pickle.loads(blob))
 
     return results
 
 
-def process_multifile(config, source, stats):
+def process_multifile(config, source, stats, pool, jobs, partials):
     '''
-    processing files procedure for sources in offline parsing. In this function the pool 
-    of proccesses is created. Each file is fragmented in chunk sizes that can be load to memory. 
-    Each process is assigned a chunk of file to be processed.
-    The results of each process are gathered to be postprocessed. 
+    processing files procedure for sources in offline parsing. Each file is fragmented in chunk sizes 
+    that can be load to memory. Each chunk is submitted to the pool of processes, and the partial
+    results are gathered as they arrive.
     '''
-    results = {}
+    if source in config['nfcapd_sources'] and not debugmode:
+        return process_nfcapd(config, source, stats, pool, jobs, partials)
+
     count = 0
     lengths = stats['sizes'][source] #filesize
 
@@ -127,24 +174,24 @@ def process_multifile(config, source, stats):
             if not debugmode:   
                 print("%s  #%s / %s  %s" %(source, str(count), str(len(config['SOURCES'][source]['FILES'])), tag))
             else:
-                faac.debugProgram('fcparser.process_multifile.source', [source, stats['lines'][source]])
+                nlogs = sum(countRecords(f, config, source) for f in config['SOURCES'][source]['FILES'])
+                faac.debugProgram('fcparser.process_multifile.source', [source, nlogs])
 
-            # Recalculate Ncores if nlogs < ncores for this datasource
-            ncores_bkp = config['Cores']
-            nlogs = stats['lines'][source]
-            if config['Cores']>1 and 10*config['Cores'] > nlogs:     
-                config['Cores'] = max(1, floor(nlogs/10))
-            
             # Multiprocessing
-            pool = mp.Pool(config['Cores'])
-            while cont:                          # cleans memory from processes
-                jobs = list()
+            while cont:
                 # Initially, data is split into chunks with size: min(filesize, max_chunk) / Ncores
-                for fragStart,fragSize in faac.frag(input_path,init,config['RECORD_SEPARATOR'][source], int(math.ceil(float(min(remain,config['Csize']))/config['Cores'])), config['Csize']):
+                if source in config['nfcapd_sources']:
+                    frags = [(0, lengths[i])]       # nfdump output is read as a whole
+                else:
+                    frags = faac.frag(input_path,init,config['RECORD_SEPARATOR'][source], faac.chunkSize(remain, config), config['Csize'])
+                for fragStart,fragSize in frags:
                     if not debugmode:
-                        jobs.append( pool.apply_async(process_file,[input_path,fragStart,fragSize,config, source, stats]) )
+                        jobs.append( (source, None, pool.apply_async(process_chunk,[source,i,fragStart,fragSize])) )
+                        # Partial results are gathered as they arrive, so only a few of them are held at a time
+                        if len(jobs) >= 2*config['Cores']:
+                            collect(jobs, partials, config, stats, pool)
                     else:
-                        stats['processed_lines'][source], obsDict = process_file(input_path,fragStart,fragSize,config,source,stats)
+                        stats['processed_lines'][source], obsDict, nlogs = process_file(input_path,fragStart,fragSize,config,source,stats)
                         
                 else:
                     if fragStart+fragSize < lengths[i]:
@@ -161,39 +208,104 @@ def process_multifile(config, source, stats):
                             remain = lengths[i] 
                             global user_input; user_input = None
 
-                            
-                for job in jobs:
-                    job_data = job.get()
-                    processed_lines = job_data[0]
-                    obsDict = job_data[1]
-                    stats['processed_lines'][source] += processed_lines
-                    results = combine(results,obsDict)
-                    
-            
-            pool.close()
-            config['Cores'] = ncores_bkp
 
-    return results 
+def process_nfcapd(config, source, stats, pool, jobs, partials):
+    '''
+    processing files procedure for nfcapd sources in offline parsing. Each file is decoded
+    inside one process of the pool, so several files are decoded concurrently.
+    The results of each process are gathered as they arrive. 
+    '''
+    files = config['SOURCES'][source]['FILES']
+    lengths = stats['sizes'][source] #filesize
+
+    for i in range(len(files)):
+        print("%s  #%s / %s  %s" %(source, str(i+1), str(len(files)), getTag(files[i])))
+        jobs.append( (source, None, pool.apply_async(process_chunk,[source,i,0,lengths[i]])) )
+        if len(jobs) >= 2*config['Cores']:
+            collect(jobs, partials, config, stats, pool)
+
+
+def collect(jobs, partials, config, stats, pool):
+    '''
+    Function to gather the oldest job submitted to the pool. The partial results of a parsing job, or the
+    result of a merging job, are added to the ones waiting to be merged, by partition. Every REDUCE_FANIN
+    results of a partition are merged by a new job of the pool.
+    '''
+    source, part, job = jobs.popleft()
+    if part is None:
+        job_data = job.get()
+        merge_results(job_data, config, source, stats)
+        blobs = enumerate(job_data[1])
+    else:
+        blobs = [(part, job.get())]
+
+    for part, blob in blobs:
+        if blob is None:
+            continue
+        partials[source][part].append(blob)
+        if len(partials[source][part]) == REDUCE_FANIN:
+            jobs.append( (source, part, pool.apply_async(reduce_partials,[partials[source][part]])) )
+            partials[source][part] = list()
+
+def merge_results(job_data, config, source, stats):
+    '''
+    Function to add the entries processed and read by a process to the stats of the data source
+    '''
+    stats['processed_lines'][source] += job_data[0]
+    if not config['Count']:
+        stats['lines'][source] += job_data[2]
+
 
 def combine(results, obsDict):
     '''
-    Function to combine the outputs of the several processes
+    Function to combine the outputs of the several processes (Counters of the observations)
     '''        
-    for key in obsDict:
-        if key in results:
-            results[key].aggregate(obsDict[key])
-        else:
-            results[key] = obsDict[key]
+    results.aggregate(obsDict)
     
     return results 
             
+def init_worker(config):
+    '''
+    Initializer of the processes of the pool. The configuration is received once by each process
+    and kept for all the chunks it is given, along with the caches warmed while parsing them.
+    '''
+    global worker_config; worker_config = config
+    global debugmode; debugmode = False     # the pool is not used in debug mode
+
+
+def process_chunk(source, file_id, fragStart, fragSize):
+    '''
+    Task of the pool of processes: processes a chunk of a file, given by the data source and the
+    index of the file in it, with the configuration received by the process when it was created.
+    The counters of the observations are split by windows into one partition per process, and 
+    each partition is pickled here (None if empty), so the main process only passes them on.
+    '''
+    file = worker_config['SOURCES'][source]['FILES'][file_id]
+    processed_lines, obsDict, nlogs = process_file(file, fragStart, fragSize, worker_config, source, None)
+    blobs = [pickle.dumps(part, pickle.HIGHEST_PROTOCOL) if len(part) else None for part in obsDict.partition(worker_config['Cores'])]
+    return processed_lines, blobs, nlogs
+
+
+def reduce_partials(blobs):
+    '''
+    Task of the pool of processes: merges pickled partial results of the same partition of windows.
+    Returns the merged result, pickled as well.
+    '''
+    results = pickle.loads(blobs[0])
+    for blob in blobs[1:]:
+        results = combine(results, pickle.loads(blob))
+    return pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+
+
 def process_file(file, fragStart, fragSize, config, source, stats):
     '''
     Function that uses each process to get data entries from  data using the separator defined
     in configuration files that will be transformed into observations. This is used only in offline parsing. 
+    Returns the number of processed entries, the counters of the observations and the number of entries read.
     '''
-    obsDict = {}
+    obsDict = faac.Counters(len(config['PLAN'][source].names))
     processed_lines = 0
+    nlogs = 0
     separator = config['RECORD_SEPARATOR'][source]
     
     if debugmode:
@@ -205,28 +317,49 @@ def process_file(file, fragStart, fragSize, config, source, stats):
         else:
             read_input = True
 
-    try:    
-        if file.endswith('.gz'):                    
-            f = gzip.open(file, 'r', newline="")
+    # Data entries are read from the file by byte offsets, through a fixed-size buffer
+    if source in config['nfcapd_sources']:
+        records = nfcapdRecords(file)           # the whole file
+    else:
+        records = faac.openData(file).records(fragStart, fragSize, separator)
+
+    # Structured data entries are parsed by batches in columnar form
+    if config['STRUCTURED'][source] and not debugmode:
+        batch = list()
+        batch_bytes = 0
+        if config['Psize']:
+            max_bytes = config['Psize'] // BATCH_EXPANSION     # batches must fit in the Memory share of the process
         else:
-            f = open(file, 'r', newline="")
-
-        f.seek(fragStart)
-        lines = f.read(fragSize)
-        #if debugmode: print("[Loaded set of %d logs]\n" %(len(lines.split(separator))))
-            
-    finally:
-        f.close()
-        
+            max_bytes = None
+        for line in records:
+            nlogs += 1
+            batch.append(line)
+            batch_bytes += len(line)
+            if len(batch) == BATCH_SIZE or (max_bytes and batch_bytes >= max_bytes):
+                batch_lines, batch_obs = process_batch(batch, config, source)
+                processed_lines += batch_lines
+                obsDict = combine(obsDict, batch_obs)
+                batch = list()
+                batch_bytes = 0
+        if batch:
+            batch_lines, batch_obs = process_batch(batch, config, source)
+            processed_lines += batch_lines
+            obsDict = combine(obsDict, batch_obs)
+
+        return processed_lines, obsDict, nlogs
    
-    for line in faac.iter_split(lines, separator):  
+    for line in records:
+        nlogs += 1
+        if isinstance(line, bytes):
+            line = line.decode()
+        text = line if isinstance(line, str) else nfcapd.formatFlow(line)
 
         if debugmode:
             if read_input:
                 opmode, user_input = faac.debugProgram('fcparser.user_input', [processed_lines+1])
                 
-            if (opmode=='enter') or (opmode=='goline' and user_input==(processed_lines+1)) or (opmode=='searchstr' and user_input in line):
-                faac.debugProgram('fcparser.process_file.line', [processed_lines+1, line])
+            if (opmode=='enter') or (opmode=='goline' and user_input==(processed_lines+1)) or (opmode=='searchstr' and user_input in text):
+                faac.debugProgram('fcparser.process_file.line', [processed_lines+1, text])
                 read_input = True        # after a match, will process line and read user input again
                 user_input = None        # Reset user_input after a match
             else:
@@ -235,8 +368,6 @@ def process_file(file, fragStart, fragSize, config, source, stats):
                 continue
                 
         tag, obs = process_log(line, config, source)
-        if tag == 0:
-            tag = file.split("/")[-1]
 
         if debugmode:
             processed_lines+=1 
@@ -246,6 +377,82 @@ def process_file(file, fragStart, fragSize, config, source, stats):
     
     #if debugmode: print('\033[33m'+ "End of file chunk. Loading next chunk..." +'\033[m')
 
+    return processed_lines, obsDict, nlogs
+
+
+def process_batch(lines, config, source):
+    '''
+    Function that transforms a batch of structured data entries into observations. The entries are parsed
+    into one column per variable, so each distinct value is converted, filtered, sampled and matched only
+    once. Entries that can not be parsed in columnar form are processed one by one with process_log.
+    Returns the number of processed entries and the counters of the observations indexed by tag.
+    '''
+    obsDict = faac.Counters(len(config['PLAN'][source].names))
+    processed_lines = 0
+
+    columns, rest = faac.parseColumns(lines, config['RECORD_VARIABLES'][source], config['TSFORMAT'][source])
+    for line in rest:
+        tag, obs = process_log(line, config, source)
+        if obs is not None:
+            add_observation(obsDict, obs, tag)
+            processed_lines+=1
+
+    if not columns:
+        return processed_lines, obsDict
+
+    # Window of each distinct timestamp (None for the timestamps left out)
+    timestamps = columns[config['TIMEARG'][source]]
+    window = config['Time']['window']
+    time_tags = list()
+    for var in timestamps.variables:
+        log_timestamp = var.value
+        tag = None
+        if not ('start' in config['Time'] and log_timestamp < config['Time']['start']) and \
+           not ('end' in config['Time'] and log_timestamp > config['Time']['end']):
+            try:
+                tag = faac.windowId(log_timestamp, window)
+            except:
+                tag = None
+        time_tags.append(tag)
+
+    # Combine the timestamp with the values of the keys (first instance of each variable)
+    codes = timestamps.codes
+    keys = list()
+    for key in config['Keys']:
+        if key not in columns:
+            time_tags = [None] * len(time_tags)     # the record would fail in process_log
+            break
+        keys.append(columns[key])
+        codes = codes * len(columns[key].variables) + columns[key].codes
+
+    tags = list()
+    tag_index = {}
+    combined, inverse = np.unique(codes, return_inverse=True)
+    mapping = np.empty(len(combined), dtype=np.int64)
+    for n, code in enumerate(combined.tolist()):
+        tag = list()
+        for column in reversed(keys):
+            tag.append(str(column.variables[code % len(column.variables)]))
+            code //= len(column.variables)
+        tag.append(time_tags[code])
+        if tag[-1] is None:
+            mapping[n] = -1
+            continue
+        tag.reverse()
+        if len(tag) > 1:
+            tag = tuple(tag)
+        else:
+            tag = tag[0]
+        if tag not in tag_index:
+            tag_index[tag] = len(tags)
+            tags.append(tag)
+        mapping[n] = tag_index[tag]
+
+    record_tags = mapping[inverse.reshape(-1)]
+    output = config['PLAN'][source].evaluateColumns(columns, record_tags, len(tags))
+    obsDict.update(tags, output)
+    processed_lines += int((record_tags >= 0).sum())
+
     return processed_lines, obsDict
 
 
@@ -255,12 +462,12 @@ def process_log(log,config, source):
     '''     
 
     ignore_log = 0      # flag to skip processing this log
-    if not log or not log.strip():  
+    if not log or (isinstance(log, str) and not log.strip()):  
         ignore_log=1    # do not process empty logs or containing only spaces
         print('\033[31m'+ "The entry log is empty and will not be processed\n" +'\033[m')
 
     if not ignore_log:
-        record = faac.Record(log,config['SOURCES'][source]['CONFIG']['VARIABLES'], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
+        record = faac.Record(log,config['RECORD_VARIABLES'][source], config['STRUCTURED'][source], config['TSFORMAT'][source], config['All'])
         if debugmode: faac.debugProgram('fcparser.process_log.record', [record])
         
         timearg = config['TIMEARG'][source] # name of variable which contains timestamp 
@@ -278,15 +485,14 @@ def process_log(log,config, source):
             ignore_log = 1
     
     if not ignore_log:
-        obs = faac.Observation.fromRecord(record, config['FEATURES'][source])
+        obs = faac.Observation.fromRecord(record, config['PLAN'][source])
         if debugmode: faac.debugProgram('fcparser.process_log.observation', [obs])
         
         window = config['Time']['window']            
         try:
             if config['Keys']:
                 tag = list()
-                tag2 = normalize_timestamps(log_timestamp, window)
-                tag.append(tag2.strftime("%Y%m%d%H%M"))
+                tag.append(faac.windowId(log_timestamp, window))
                 for i in range(len(config['Keys'])):
                     if len(record.variables[config['Keys'][i]]) > 0:
                         tag.append(str(record.variables[config['Keys'][i]][0]))    # Careful!, only works (intentionally) for the first instance of a variable in a record
@@ -295,8 +501,7 @@ def process_log(log,config, source):
                 else:
                     tag = tag[0]        
             else:
-                tag2 = normalize_timestamps(log_timestamp, window)
-                tag = tag2.strftime("%Y%m%d%H%M")
+                tag = faac.windowId(log_timestamp, window)
 
         except: 
             # Exception as err
@@ -311,78 +516,27 @@ def process_log(log,config, source):
     return tag, obs
     
 
-def normalize_timestamps(t, window):
-    '''
-    Function that transform timestamps of data entries to a normalized format. It also do the 
-    time sampling using the time window defined in the configuration file.
-    '''    
-    #try:
-    if window == 0:
-        return 0
-    if window <= 60:
-        new_minute = t.minute - t.minute % window  
-        t = t.replace(minute = new_minute, second = 0)
-    elif window <= 1440:
-        window_m = window % 60  # for simplicity, if window > 60 we only use the hours
-        window_h = int((window - window_m) / 60)
-        new_hour = t.hour - t.hour % window_h  
-        t = t.replace(hour = new_hour, minute = 0, second = 0)                 
-    return t
-    #except Exception as err: print("[!] Normalizing error: "+str(err))
-        
-    return 0
-
-        
-        
 def fuseObs_offline(resultado):
     '''
-    Sources Fusion in a single stream. 
+    Sources Fusion in a single stream. The counters of each source are placed after the ones
+    of the previous sources, with zeros for the tags missing in a source. 
     '''
+    fused_res = faac.Counters(sum(counters.data.shape[1] for counters in resultado.values()))
 
-    v = list(resultado.keys())
-    fused_res = resultado[v[0]]
-
-
-    for source in v[1:]:
-
-        # Get len of data vector in observation object from that source
-        arbitrary_len2 = len(next(iter(list(resultado[source].values()))).data)
-        try:
-            arbitrary_len = len(next(iter(list(fused_res.values()))).data)
-        except:
-            arbitrary_len = 0
-
-        for date in resultado[source]:
-
-            if date not in fused_res:
-                fused_res[date] = resultado[source][date]
-                # add zero observation vector before
-                fused_res[date].zeroPadding(arbitrary_len, position=-1)
-            else:
-                fused_res[date].fuse(resultado[source][date].data) 
-                
-                
-        for date2 in fused_res:
-
-            if date2 not in resultado[source]:
-                # add zero observation vector after
-                fused_res[date2].zeroPadding(arbitrary_len2, position=0)
-                #fused_res[date2].fuse([0]*arbitrary_len2) # old implementation (master branch)
-
-    return fused_res
-
-
+    start = 0
+    for source in resultado:
+        counters = resultado[source]
+        fused_res.update(counters.keys, counters.data[:len(counters)], start)
+        start += counters.data.shape[1]
 
+    return fused_res.observations()
 
 
 def add_observation(obsDict,obs,tag):
     '''
-    Adds an observation (obs) to dictionary (obsDict) in an entry (tag) 
+    Adds an observation (obs) to the counters (obsDict) of an entry (tag) 
     '''
-    if tag in list(obsDict.keys()):
-        obsDict[tag].aggregate(obs)
-    else:
-        obsDict[tag] = obs
+    obsDict.add(tag, obs.data)
     
 
 def getTag(filename):
@@ -396,59 +550,6 @@ def getTag(filename):
         return None
 
 
-def file_len(fname):
-    '''
-    Function to get lines from a file
-    '''
-    count_log = 0
-    try:
-        if fname.endswith('.gz'):
-            input_file = gzip.open(fname,'r')
-        else:
-            input_file = open(fname,'r')
-
-        for count_log, l in enumerate(input_file):
-            pass
-
-    finally:
-        size = input_file.tell()
-        input_file.close()
-
-    return count_log+1,size
-
-
-def file_uns_len(fname, separator):
-    '''
-    Function determine de number of logs for a unstructured file 
-    '''
-    count_log = 0
-    try:
-        if fname.endswith('.gz'):
-            input_file = gzip.open(fname,'r')
-        else:
-            input_file = open(fname,'r')
-        
-        log ="" 
-        for line in input_file:        
-            log += line 
-
-            splitt = log.split(separator);
-            if len(splitt) > 1:
-                count_log += 1    
-                log = log[len(splitt[0])+1:]
-        
-        if not log or not log.strip():
-            pass
-        else: 
-            count_log+=1    # count last log when it is not empty or containing spaces only
-
-    finally:
-        size = input_file.tell()
-        input_file.close()
-
-    return count_log,size    
-
-
 def create_stats(config):
     '''
     Legacy function - To be updated
@@ -467,42 +568,67 @@ def create_stats(config):
 
 def count_entries(config,stats):
     '''
-    Function to get the amount of data entries and bytes for each data source
+    Function to get the amount of bytes for each data source. Files are split by size, so data entries
+    are counted by the processes while they are parsed, unless Count_entries is set in the configuration.
     '''
 
-    lines = {}
+    stats['lines'] = {}
     stats['processed_lines'] = {}
     stats['sizes'] = {}
     for source in config['SOURCES']:
-        lines[source] = 0
+        stats['lines'][source] = 0
         stats['processed_lines'][source] = 0
         stats['sizes'][source] = list()
         for file in config['SOURCES'][source]['FILES']:
-            
-            if config['STRUCTURED'][source]:
-                (l,s) = file_len(file)
-                lines[source] += l
-                stats['sizes'][source].append(s)
-                
-            # unstructured source
-            else:
-                (l,s) = file_uns_len(file,config['RECORD_SEPARATOR'][source])
-                lines[source] += l
-                stats['sizes'][source].append(s)
+            stats['sizes'][source].append(faac.dataSize(file))
+            if config['Count']:
+                stats['lines'][source] += countRecords(file, config, source)
 
-    # Sum lines from all datasources to obtain total lines.
-    total_lines = 0
+    return stats
 
-    stats['lines'] = {}
-    for source in lines:
-        total_lines += lines[source]
-        stats['lines'][source] = lines[source]
 
-    stats['total_lines'] = total_lines
-    
-    
-    return stats            
-    
+def countRecords(file, config, source):
+    '''
+    Function to count the data entries of a file of the data source. nfcapd files are counted on
+    their csv conversion by nfdump.
+    '''
+    if source in config['nfcapd_sources']:
+        return sum(1 for record in nfcapdRecords(file))
+    return faac.countRecords(file, config['RECORD_SEPARATOR'][source])
+
+
+def nfcapdRecords(file):
+    '''
+    Function to read the data entries of a nfcapd file. Flows are decoded natively, as tuples of typed
+    fields, unless the file is not supported by the nfcapd module: then it is converted to csv by nfdump.
+    '''
+    if nfcapd.supported(file):
+        return nfcapd.readFlows(file)
+    return faac.nfdumpRecords(file)
+
+
+def checkNfcapd(config):
+    '''
+    Function to check that nfdump is installed if some nfcapd file can not be decoded natively
+    '''
+    for source in config['nfcapd_sources']:
+        for file in config['SOURCES'][source]['FILES']:
+            if not nfcapd.supported(file) and shutil.which(faac.NFDUMP) is None:
+                print('\033[31m'+ "**CONFIG FILE ERROR** '%s' is required to parse nfcapd file '%s' and it was not found" %(faac.NFDUMP, file) +'\033[m')
+                exit(1)
+
+
+def checkStateStore(config, incremental, export):
+    '''
+    Function to check, before parsing or writing any output, that the state store of incremental
+    runs matches the configured keys and features. Exports require an existing store.
+    '''
+    if export and not os.path.isfile(config['OUTDIR'] + faac.STATE_INDEX):
+        print('\033[31m'+ "No state store of incremental runs found in %s" %(config['OUTDIR']) +'\033[m')
+        exit(1)
+    if incremental:
+        faac.StateStore(config['OUTDIR'], featureNames(config), config['Keys']).close()
+
 
 def prettyTime(elapsed):
     '''
@@ -526,6 +652,7 @@ def getArguments():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description='''Multivariate Analysis Parsing Tool.''')
     parser.add_argument('config', metavar='CONFIG', help='Parser Configuration File.')
     parser.add_argument('-d', '-g', '--debug', action='store_true', help="Run fcparser in debug mode")
+    parser.add_argument('-e', '--export', action='store_true', help="Regenerate the output files from the state store of incremental runs, without parsing")
     args = parser.parse_args()
     return args
 
@@ -586,95 +713,140 @@ def write_output(output, config):
     Furthermore, an adition file with a list of the features is ouputted.
     '''
 
+    features = featureNames(config)
+    with open(config['OUTDIR'] + 'headers.dat', 'w') as f:
+        f.write(str(features))
+
+    if isinstance(output, dict) and config['Incremental']:
+        # Observations are merged into the state store, and only the windows of this run are written
+        store = faac.StateStore(config['OUTDIR'], features, config['Keys'])
+        tags = store.merge(output, config['Time']['window'])
+        if config['OUTFORMAT'] != 'matrix':
+            write_windows(store, tags, config)
+        if config['OUTFORMAT'] != 'text':
+            write_store_matrix(store, config, features)
+        store.close()
+
+    elif isinstance(output, dict):
+        keys = sorted(output)
+        if config['OUTFORMAT'] != 'matrix':
+            # Rows are grouped by timestamp and each file is written in one pass, several files at a time
+            with ThreadPoolExecutor(max_workers=config['Cores']) as pool:
+                jobs = [pool.submit(write_group, list(group), output, config) for tag, group in groupby(keys, key=windowOf)]
+                for job in jobs:
+                    job.result()    # raises the errors of the writer
+        if config['OUTFORMAT'] != 'text':
+            write_matrix([(faac.windowTag(windowOf(k), config['Time']['window']), keyName(k) or '') for k in keys],
+                         [output[k].data for k in keys], config, features)
+    else:
+        if config['OUTFORMAT'] != 'matrix':
+            with open(config['OUTDIR'] + 'output.dat' , 'w') as f:
+                f.write(','.join(map(str,output.data.tolist())))
+        if config['OUTFORMAT'] != 'text':
+            faac.writeMatrix(config['OUTDIR'], [('', '')], output.data.reshape(1, -1))
+
+
+def export_output(config):
+    '''Regenerate the output files of all the windows from the state store of incremental runs
+    (Incremental_Output), without parsing any data
+    '''
+    features = featureNames(config)
+    with open(config['OUTDIR'] + 'headers.dat', 'w') as f:
+        f.write(str(features))
+
+    store = faac.StateStore(config['OUTDIR'], features, config['Keys'])
+    tags = sorted(store.windows)
+    print("Exporting %d windows (%d rows)" %(len(tags), len(store.keys)))
+    if config['OUTFORMAT'] != 'matrix':
+        write_windows(store, tags, config)
+    if config['OUTFORMAT'] != 'text':
+        write_store_matrix(store, config, features)
+    store.close()
+
+
+def featureNames(config):
+    '''
+    Function to get the names of the features of all the data sources, in output order
+    '''
     features = []
     for source in config['SOURCES']:
         for feat in config['SOURCES'][source]['CONFIG']['FEATURES']:
             features.append(feat['name'])
+    return features
 
-    with open(config['OUTDIR'] + 'headers.dat', 'w') as f:
-        f.write(str(features))
 
-    if isinstance(output, dict):
-        
-        # List of files, one for each timestamp
-        lfiles = list();
-        for k in output:
-            if isinstance(k, tuple):
-                tag = k[0]
-            else:
-                tag = k
-                
-            if tag not in lfiles:
-                lfiles.append(tag)
-                
-        if config['Incremental']:
-            for i in range(len(lfiles)):
-                
-                tagt = lfiles[i]
-                fname = config['OUTDIR'] + 'output-'+ tagt + '.dat'
-                if os.path.isfile(fname):
-                    with open(fname, 'r') as f:
-
-                        for line in f:
-
-                            if line.find(':')==-1:
-                                obs_aux = line
-                                tag = tagt
-
-                            else:
-                                laux = line.rsplit(': ',2)
-                                tag = [tagt]
-
-                                tagso =  laux[0].split(',')
-                                list(map(str.strip,tagso))
-                                for j in range(len(tagso)):
-                                    tag.append(tagso[j])
-
-                                obs_aux = laux[1]
-                                tag = tuple(tag)
-
-                            obs = obs_aux.split(',')
-
-                            try:
-                                for j in range(len(obs)):
-                                    obs[j] = int(obs[j])
-                            except:
-                                obs = []
-
-                            if tag in output:
-                                for j in range(len(obs)):
-                                    output[tag].data[j].value += obs[j]
-                            else:
-                                j = 0;
-                                data = []
-                                for source in config['SOURCES']:
-                                    for feat in config['SOURCES'][source]['CONFIG']['FEATURES']:
-                                        data.append(faac.Feature(feat))
-                                        data[j].value += obs[j]
-                                        j += 1
-
-                                output[tag] = faac.Observation(data)
-                
-                    open(fname, 'w').close()
+def windowOf(key):
+    '''
+    Function to get the timestamp (window id) of a key of the output observations
+    '''
+    if isinstance(key, tuple):
+        return key[0]
+    return key
 
 
-        l = OrderedDict(sorted(output.items()))
-        for k in list(l.keys()):
-            if isinstance(k, tuple):
-                tag = k[0]
-            else:
-                tag = k
-                
-            fname = config['OUTDIR'] + 'output-'+ tag + '.dat'
-            with open(fname, 'a') as f:
-                if isinstance(k, tuple):
-                    tag2 = list(map(str.strip,k[1:]))
-                    f.write(','.join(tag2)+': ')
-                
-                f.write(','.join(map(str,output[k].data))+ '\n')
-    else:
-        with open(config['OUTDIR'] + 'output.dat' , 'w') as f:
-            f.write(','.join(map(str,output.data)))
+def keyName(key):
+    '''
+    Function to get the name of a key of the output observations (values of the aggregation keys
+    joined by commas), as written before its counters. None if there are no aggregation keys.
+    '''
+    if isinstance(key, tuple):
+        return ','.join(map(str.strip,key[1:]))
+    return None
+
+
+def write_window(tag, names, data, config):
+    '''Write the output file of a timestamp, with one line for each of the key names given (all of them
+    of the timestamp) and their counters, in one buffered pass
+    '''
+    lines = faac.formatRows(data)
+    for i in range(len(names)):
+        if names[i] is not None:
+            lines[i] = names[i] + ': ' + lines[i]
+
+    fname = config['OUTDIR'] + 'output-'+ tag + '.dat'
+    with open(fname, 'w') as f:
+        f.writelines(lines)
+
+
+def write_group(keys, output, config):
+    '''Write the output file of a timestamp from the observations of its keys (all of them of the timestamp)
+    '''
+    tag = faac.windowTag(windowOf(keys[0]), config['Time']['window'])
+    write_window(tag, list(map(keyName, keys)), [output[k].data for k in keys], config)
+
+
+def write_windows(store, tags, config):
+    '''Write the output files of some timestamps from the state store, several files at a time
+    '''
+    with ThreadPoolExecutor(max_workers=config['Cores']) as pool:
+        jobs = [pool.submit(write_store_window, tag, store, config) for tag in tags]
+        for job in jobs:
+            job.result()    # raises the errors of the writer
+
+
+def write_store_window(tag, store, config):
+    '''Write the output file of a timestamp with its rows in the state store
+    '''
+    names, data = store.window(tag)
+    write_window(tag, names, data, config)
+
+
+def write_store_matrix(store, config, features):
+    '''Write the matrix output of all the windows accumulated in the state store of incremental runs
+    '''
+    rows = sorted(range(len(store.keys)), key=lambda row: (store.keys[row][0], store.keys[row][1] or ''))
+    write_matrix([(store.keys[row][0], store.keys[row][1] or '') for row in rows], store.counters[rows], config, features)
+
+
+def write_matrix(rows, data, config, features):
+    '''Write parsing output as a single matrix for the whole run, with one row for each timestamp
+    (and key), plus the row index of (window tag, key name)
+    '''
+    matrix = np.zeros((len(rows), len(features)), dtype=np.int64)
+    for i in range(len(rows)):
+        matrix[i, :len(data[i])] = data[i]
+
+    faac.writeMatrix(config['OUTDIR'], rows, matrix)
             
             
 def online_parsing(config):
@@ -686,50 +858,17 @@ def online_parsing(config):
     results = {}
 
     for source in config['SOURCES']:
-        obsDict = obsDict_online()
-        
-        # If structured datasource
-        if config['SOURCES'][source]['CONFIG']['structured']:
-            for fname in config['SOURCES'][source]['FILES']:
-
-                try:
-    
-                    if fname.endswith('.gz'):                    
-                        f = gzip.open(fname, 'r')
-                    else:
-                        f = open(fname, 'r')
-                
-                    lines = f.readlines()
-                    for line in lines:
-                        tag, obs = process_log(line,config,source)
-                        obsDict.add(obs)
-                finally:
-                    f.close()
-        else:
-            separator = config['RECORD_SEPARATOR'][source]
-            for fname in config['SOURCES'][source]['FILES']:
-
-                try:
-    
-                    if fname.endswith('.gz'):                    
-                        f = gzip.open(fname, 'r')
-                    else:
-                        f = open(fname, 'r')
-
-                    lines = f.read()
-                    log = ''
-                    for line in lines:
-                        log += line 
-                        if separator in log:
-                            tag, obs = process_log(log,config, source)
-                            obsDict.add(obs)
-                            log = ''    
-
-                    tag, obs = process_log(log,config, source)
+        obsDict = obsDict_online(len(config['FEATURES'][source]))
+        separator = config['RECORD_SEPARATOR'][source]
+
+        for fname in config['SOURCES'][source]['FILES']:
+            f = faac.openInput(fname)
+            try:
+                for offset, log in faac.readRecords(f, separator):
+                    tag, obs = process_log(log.decode(), config, source)
                     obsDict.add(obs)
-
-                finally:
-                    f.close()
+            finally:
+                f.close()
 
         results[source] = obsDict
     return results
@@ -737,15 +876,15 @@ def online_parsing(config):
 
 def fuseObs_online(resultado):
     '''
-    Function to fuse all the results obtained from all the processes to form a single observation in 
-    array form.
+    Function to fuse the observations obtained from all the data sources to form a single observation.
     '''
-    fused_res = []
-    #features = []
+    fused_res = None
 
     for source in resultado:
-
-        fused_res = fused_res + resultado[source].obsList
+        if fused_res is None:
+            fused_res = resultado[source].obs
+        else:
+            fused_res.fuse(resultado[source].obs.data)
 
     return fused_res
 
@@ -756,17 +895,15 @@ class obsDict_online(object):
     methods to add new partial observation to an absolute observation and a other 
     method for visual representation.
     """
-    def __init__(self):
-        self.obsList = []
+    def __init__(self, nfeatures):
+        self.obs = faac.Observation(np.zeros(nfeatures, dtype=np.int64))
 
     def add(self,obs):
-        if self.obsList:
-            self.obsList = list(map(add, obs, self.obsList)) # won't work in new code
-        else:
-            self.obsList = obs
+        if obs is not None:
+            self.obs.aggregate(obs)
 
     def printt(self):
-        print(self.obsList)
+        print(self.obs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,498 @@
+"""
+
+nfcapd -- Native reader of nfcapd binary files (netflow data collected by nfdump).
+
+Flows are decoded straight from the data blocks of the file, so nfcapd sources
+are parsed without running nfdump and without formatting and parsing csv text.
+Each flow is returned as a tuple with the fields of the csv output of nfdump
+(see CSV_FIELDS), already typed: timestamps as datetime objects, addresses as
+faac.IPAddress objects and counters as numbers. The 'where' of the variables of
+nfcapd sources refers to the positions of those fields, as for csv files.
+
+Supported layouts:
+- LAYOUT_VERSION_1 (nfdump 1.6): common records with extension maps.
+- LAYOUT_VERSION_2 (nfdump 1.7): V3 records with elements.
+Data blocks can be uncompressed or compressed with LZO (package 'python-lzo'),
+BZ2, LZ4 (package 'lz4') or ZSTD (package 'zstandard').
+
+"""
+
+import bz2
+import struct
+from datetime import datetime
+from faac import IPAddress
+from IPy import IP
+
+# Optional compression formats
+try:
+    import lzo
+except ImportError:
+    lzo = None
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = 0xA50C
+LAYOUT_VERSION_1 = 1
+LAYOUT_VERSION_2 = 2
+MAX_BLOCK_SIZE = 5<<20          # uncompressed size of data blocks is at most 5 MB
+
+# Fields of a flow, in the order of the csv output of nfdump
+CSV_FIELDS = ('ts', 'te', 'td', 'sa', 'da', 'sp', 'dp', 'pr', 'flg', 'fwd', 'stos', 'ipkt', 'ibyt',
+              'opkt', 'obyt', 'in', 'out', 'sas', 'das', 'smk', 'dmk', 'dtos', 'dir', 'nh', 'nhb',
+              'svln', 'dvln', 'ismc', 'odmc', 'idmc', 'osmc') + \
+             tuple('mpls%d' %(i) for i in range(1, 11)) + \
+             ('cl', 'sl', 'al', 'ra', 'eng', 'exid', 'tr')
+FIELD = {name: i for i, name in enumerate(CSV_FIELDS)}
+DECIMAL_FIELDS = (FIELD['td'], FIELD['cl'], FIELD['sl'], FIELD['al'])   # printed with 3 decimals
+
+# Protocol names printed by nfdump (other protocols are printed as numbers)
+PROTOCOLS = {1: 'ICMP', 2: 'IGMP', 3: 'GGP', 4: 'IPIP', 5: 'ST', 6: 'TCP', 8: 'EGP', 9: 'IGP', 17: 'UDP',
+             41: 'IPv6', 43: 'Rte6', 44: 'Frag6', 46: 'RSVP', 47: 'GRE', 50: 'ESP', 51: 'AH', 58: 'ICMP6',
+             59: 'NoNxt', 60: 'Opts6', 88: 'EIGRP', 89: 'OSPF', 103: 'PIM', 112: 'VRRP',
+             115: 'L2TP', 132: 'SCTP'}
+
+FILE_HEADER_V1 = struct.Struct('<HHII128s')     # magic, version, flags, blocks, ident
+STAT_RECORD_SIZE = 136
+FILE_HEADER_V2 = struct.Struct('<HHIQBBHIQII')  # magic, version, nfdversion, created, compression, encryption,
+                                                # appendix blocks, unused, appendix offset, block size, blocks
+BLOCK_HEADER = struct.Struct('<IIHH')           # records, size, type, flags
+RECORD_HEADER = struct.Struct('<HH')            # type, size
+
+# Compression of the data blocks: flags of LAYOUT_VERSION_1 files and codes of LAYOUT_VERSION_2 files
+FLAG_LZO, FLAG_BZ2, FLAG_LZ4, FLAG_ZSTD = 0x1, 0x8, 0x10, 0x20
+COMPRESSION_V2 = {0: None, 1: 'lzo', 2: 'bz2', 3: 'lz4', 4: 'zstd'}
+
+# Record types
+COMMON_RECORD_V0 = 1
+EXTENSION_MAP = 2
+COMMON_RECORD = 10
+V3_RECORD = 11
+
+COMMON_V0 = struct.Struct('<BBHHHIIBBBBHH')     # flags, exporter, map, msec first/last, first, last,
+COMMON_V1 = struct.Struct('<HHHHIIBBBBHHHBB')   # fwd status, tcp flags, protocol, tos, ports (+ exporter)
+FLAG_IPV6_ADDR, FLAG_PKG_64, FLAG_BYTES_64 = 0x1, 0x2, 0x4
+
+# Size of the extensions of common records, by extension id (1 to 3 are always present)
+EXTENSION_SIZE = {4: 4, 5: 8, 6: 4, 7: 8, 8: 4, 9: 4, 10: 16, 11: 4, 12: 16, 13: 4, 14: 4, 15: 8, 16: 4, 17: 8,
+                  18: 4, 19: 8, 20: 16, 21: 16, 22: 40, 23: 4, 24: 16, 25: 4, 26: 8, 27: 8,
+                  28: 0, 29: 0, 30: 0, 31: 0, 32: 0, 33: 0, 34: 0, 35: 0, 36: 0,
+                  37: 20, 38: 4, 39: 8, 40: 32, 41: 24, 42: 24, 43: 72, 44: 0, 45: 12, 46: 0, 47: 8, 48: 0}
+
+V3_HEADER = struct.Struct('<HHHBBHBB')          # type, size, elements, engine type/id, exporter, flags, version
+GENERIC_FLOW = struct.Struct('<QQQQQHHBBBB')
+
+
+class NfcapdError(Exception):
+    """Error raised when a file is not a nfcapd file that can be decoded.
+    """
+    pass
+
+
+def readHeader(fname):
+    '''
+    Reads the file header of a nfcapd file.
+    Returns a tuple (layout, compression, offset, end): the layout version, the compression of the
+    data blocks (None, 'lzo', 'bz2', 'lz4' or 'zstd'), the offset of the first data block and the
+    offset where data blocks end (None for the end of the file).
+    Raises NfcapdError if the file is not a nfcapd file of a known layout.
+    '''
+    with open(fname, 'rb') as f:
+        header = f.read(FILE_HEADER_V1.size + STAT_RECORD_SIZE)
+    if len(header) < 4:
+        raise NfcapdError("'%s' is not a nfcapd file" %(fname))
+    magic, version = RECORD_HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise NfcapdError("'%s' is not a nfcapd file" %(fname))
+
+    if version == LAYOUT_VERSION_1 and len(header) == FILE_HEADER_V1.size + STAT_RECORD_SIZE:
+        flags = FILE_HEADER_V1.unpack_from(header)[2]
+        compression = None
+        for flag, name in ((FLAG_LZO, 'lzo'), (FLAG_BZ2, 'bz2'), (FLAG_LZ4, 'lz4'), (FLAG_ZSTD, 'zstd')):
+            if flags & flag:
+                compression = name
+        return version, compression, FILE_HEADER_V1.size + STAT_RECORD_SIZE, None
+
+    if version == LAYOUT_VERSION_2 and len(header) >= FILE_HEADER_V2.size:
+        fields = FILE_HEADER_V2.unpack_from(header)
+        if fields[4] not in COMPRESSION_V2:
+            raise NfcapdError("Unknown compression (%d) in nfcapd file '%s'" %(fields[4], fname))
+        if fields[5]:
+            raise NfcapdError("Encrypted nfcapd file '%s'" %(fname))
+        return version, COMPRESSION_V2[fields[4]], FILE_HEADER_V2.size, fields[8] or None
+
+    raise NfcapdError("Unknown layout version (%d) in nfcapd file '%s'" %(version, fname))
+
+
+def decompressor(compression):
+    '''
+    Returns the function that decompresses the data blocks, or None if the package
+    needed for the compression is not installed.
+    '''
+    if compression is None:
+        return lambda data: data
+    if compression == 'bz2':
+        return bz2.decompress
+    if compression == 'lzo' and lzo:
+        return lambda data: lzo.decompress(data, False, MAX_BLOCK_SIZE)
+    if compression == 'lz4' and lz4block:
+        return lambda data: lz4block.decompress(data, uncompressed_size=MAX_BLOCK_SIZE)
+    if compression == 'zstd' and zstandard:
+        return lambda data: zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_BLOCK_SIZE)
+    return None
+
+
+def supported(fname):
+    '''
+    Checks whether a nfcapd file can be decoded by this module (known layout and
+    compression, with the package for the compression installed).
+    '''
+    try:
+        return decompressor(readHeader(fname)[1]) is not None
+    except (NfcapdError, OSError):
+        return False
+
+
+def readBlocks(fname):
+    '''
+    Generator of the data blocks of a nfcapd file, as tuples (type, data) with the
+    data decompressed.
+    '''
+    layout, compression, offset, end = readHeader(fname)
+    decompress = decompressor(compression)
+    if decompress is None:
+        raise NfcapdError("Package for %s compression of nfcapd file '%s' is not installed" %(compression, fname))
+
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        while end is None or offset < end:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            records, size, btype, flags = BLOCK_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                print('\033[33m'+ "Warning: truncated data block in nfcapd file '%s'" %(fname) +'\033[m')
+                break
+            offset += BLOCK_HEADER.size + size
+            if records:
+                yield btype, decompress(data)
+
+
+def readFlows(fname):
+    '''
+    Generator of the flows of a nfcapd file, as tuples of typed fields in the order of CSV_FIELDS.
+    '''
+    decoder = FlowDecoder()
+    for btype, data in readBlocks(fname):
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            rtype, size = RECORD_HEADER.unpack_from(data, pos)
+            if size < RECORD_HEADER.size or pos + size > len(data):
+                print('\033[33m'+ "Warning: corrupt record in nfcapd file '%s'" %(fname) +'\033[m')
+                break
+            if rtype == V3_RECORD:
+                yield decoder.v3Record(data, pos, size)
+            elif rtype == COMMON_RECORD or rtype == COMMON_RECORD_V0:
+                flow = decoder.commonRecord(data, pos, size, rtype)
+                if flow is not None:
+                    yield flow
+            elif rtype == EXTENSION_MAP:
+                decoder.extensionMap(data, pos, size)
+            pos += size
+
+
+def formatFlow(flow):
+    '''
+    Returns a flow as a line of the csv output of nfdump.
+    '''
+    fields = list()
+    for i, value in enumerate(flow):
+        if i in DECIMAL_FIELDS:
+            fields.append('%.3f' %(value))
+        else:
+            fields.append(str(value))
+    return ','.join(fields)
+
+
+class FlowDecoder(object):
+    """Decoder of the flow records of the data blocks of a nfcapd file.
+
+    Timestamps and addresses repeat a lot among the flows of a file, so their
+    objects are cached and shared by the flows.
+
+    Class Attributes:
+        maps      -- Extension maps of common records: tuples of extension ids, indexed by map id.
+        times     -- Cache of datetime objects, indexed by epoch seconds.
+        addresses -- Cache of IPAddress objects, indexed by (version, address).
+        layouts   -- Structs of the fixed part of common records, indexed by (type, flags).
+        default   -- Default values of the fields of a flow.
+    """
+    def __init__(self):
+        self.maps = {}
+        self.times = {}
+        self.addresses = {}
+        self.layouts = {}
+        self.default = self.defaultFlow()
+
+    def extensionMap(self, data, pos, size):
+        """Loads an extension map record.
+        """
+        map_id = struct.unpack_from('<H', data, pos + 4)[0]
+        count = (size - 8) // 2
+        ids = struct.unpack_from('<%dH' %(count), data, pos + 8)
+        self.maps[map_id] = ids[:ids.index(0)] if 0 in ids else ids     # the list of ids ends with 0
+
+    def time(self, seconds):
+        """Returns the (local) datetime of some epoch seconds, as printed by nfdump.
+        """
+        value = self.times.get(seconds)
+        if value is None:
+            value = self.times[seconds] = datetime.fromtimestamp(seconds)
+        return value
+
+    def ip(self, address, version=4):
+        """Returns the IPAddress object of an address given as an integer.
+        """
+        value = self.addresses.get((version, address))
+        if value is None:
+            if version == 4:
+                text = '%d.%d.%d.%d' %(address >> 24, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff)
+            else:
+                text = str(IP(address, ipversion=6))
+            value = self.addresses[(version, address)] = IPAddress(version, address, 32 if version == 4 else 128, text)
+        return value
+
+    def ip6(self, data, pos):
+        """Returns the IPv6 address stored in data at pos (two 64 bits words, high word first).
+        """
+        high, low = struct.unpack_from('<QQ', data, pos)
+        return self.ip((high << 64) | low, 6)
+
+    def defaultFlow(self):
+        """Returns a tuple with the default values of the fields of a flow, as printed by nfdump
+        when they are missing in the record.
+        """
+        flow = [0] * len(CSV_FIELDS)
+        zero = self.ip(0)
+        for name in ('sa', 'da', 'nh', 'nhb', 'ra'):
+            flow[FIELD[name]] = zero
+        for name in ('ismc', 'odmc', 'idmc', 'osmc'):
+            flow[FIELD[name]] = mac(0)
+        for i in range(1, 11):
+            flow[FIELD['mpls%d' %(i)]] = '0-0-0'
+        flow[FIELD['cl']] = flow[FIELD['sl']] = flow[FIELD['al']] = 0.0
+        flow[FIELD['eng']] = '0/0'
+        flow[FIELD['tr']] = self.time(0)
+        return tuple(flow)
+
+    def common(self, flow, first, msec_first, last, msec_last, fwd_status, tcp_flags, prot, tos, srcport, dstport):
+        """Fills the fields of the common part of a flow.
+        """
+        times = self.times
+        flow[0] = times[first] if first in times else self.time(first)
+        flow[1] = times[last] if last in times else self.time(last)
+        flow[2] = ((last - first) * 1000 + msec_last - msec_first) / 1000
+        flow[5] = srcport
+        flow[6] = icmpPort(dstport) if prot == 1 or prot == 58 else dstport
+        flow[7] = PROTOCOL_NAMES[prot]
+        flow[8] = TCP_FLAGS[tcp_flags]
+        flow[9] = fwd_status
+        flow[10] = tos
+
+    def layout(self, rtype, flags):
+        """Returns the Struct of the fixed part of common records of a type with some flags:
+        the common fields and the required extensions (addresses, packets and bytes).
+        """
+        key = (rtype, flags & (FLAG_IPV6_ADDR | FLAG_PKG_64 | FLAG_BYTES_64))
+        layout = self.layouts.get(key)
+        if layout is None:
+            fmt = (COMMON_V0 if rtype == COMMON_RECORD_V0 else COMMON_V1).format
+            fmt += 'QQQQ' if flags & FLAG_IPV6_ADDR else 'II'
+            fmt += 'Q' if flags & FLAG_PKG_64 else 'I'
+            fmt += 'Q' if flags & FLAG_BYTES_64 else 'I'
+            layout = self.layouts[key] = struct.Struct(fmt)
+        return layout
+
+    def commonRecord(self, data, pos, size, rtype):
+        """Decodes a common record (nfdump 1.6) into a flow.
+        Returns None if the extension map of the record is unknown.
+        """
+        layout = self.layout(rtype, data[pos + 4])
+        fields = layout.unpack_from(data, pos + 4)
+        if rtype == COMMON_RECORD_V0:
+            flags, exporter, map_id = fields[:3]
+            common = fields[3:13]
+            required = fields[13:]
+        else:
+            flags, map_id = fields[:2]
+            common = fields[2:12]
+            exporter = fields[12]
+            required = fields[15:]
+        if map_id not in self.maps:
+            return None
+
+        flow = list(self.default)
+        msec_first, msec_last, first, last = common[:4]
+        self.common(flow, first, msec_first, last, msec_last, *common[4:])
+        flow[46] = exporter
+
+        # Required extensions: addresses, packets and bytes
+        if flags & FLAG_IPV6_ADDR:
+            flow[3] = self.ip((required[0] << 64) | required[1], 6)
+            flow[4] = self.ip((required[2] << 64) | required[3], 6)
+        else:
+            addresses = self.addresses
+            flow[3] = addresses[(4, required[0])] if (4, required[0]) in addresses else self.ip(required[0])
+            flow[4] = addresses[(4, required[1])] if (4, required[1]) in addresses else self.ip(required[1])
+        flow[11], flow[12] = required[-2:]
+        ext = pos + 4 + layout.size
+
+        # Optional extensions of the map
+        end = pos + size
+        for ex_id in self.maps[map_id]:
+            if ex_id not in EXTENSION_SIZE or ext + EXTENSION_SIZE[ex_id] > end:
+                break           # unknown extension: the position of the next ones is unknown
+            self.extension(flow, ex_id, data, ext)
+            ext += EXTENSION_SIZE[ex_id]
+
+        return tuple(flow)
+
+    def extension(self, flow, ex_id, data, pos):
+        """Fills the fields of a flow from an extension of a common record.
+        """
+        if ex_id == 4 or ex_id == 5:
+            flow[15], flow[16] = struct.unpack_from('<HH' if ex_id == 4 else '<II', data, pos)
+        elif ex_id == 6 or ex_id == 7:
+            flow[17], flow[18] = struct.unpack_from('<HH' if ex_id == 6 else '<II', data, pos)
+        elif ex_id == 8:
+            flow[21], flow[22], flow[19], flow[20] = struct.unpack_from('<BBBB', data, pos)
+        elif ex_id == 9:
+            flow[23] = self.ip(struct.unpack_from('<I', data, pos)[0])
+        elif ex_id == 10:
+            flow[23] = self.ip6(data, pos)
+        elif ex_id == 11:
+            flow[24] = self.ip(struct.unpack_from('<I', data, pos)[0])
+        elif ex_id == 12:
+            flow[24] = self.ip6(data, pos)
+        elif ex_id == 13:
+            flow[25], flow[26] = struct.unpack_from('<HH', data, pos)
+        elif ex_id in (14, 15, 16, 17):
+            value = struct.unpack_from('<I' if ex_id % 2 == 0 else '<Q', data, pos)[0]
+            flow[13 if ex_id < 16 else 14] = value
+        elif ex_id == 20:
+            in_src, out_dst = struct.unpack_from('<QQ', data, pos)
+            flow[27], flow[28] = mac(in_src), mac(out_dst)
+        elif ex_id == 21:
+            in_dst, out_src = struct.unpack_from('<QQ', data, pos)
+            flow[29], flow[30] = mac(in_dst), mac(out_src)
+        elif ex_id == 22:
+            for i, label in enumerate(struct.unpack_from('<10I', data, pos)):
+                flow[31 + i] = mpls(label)
+        elif ex_id == 23:
+            flow[44] = self.ip(struct.unpack_from('<I', data, pos)[0])
+        elif ex_id == 24:
+            flow[44] = self.ip6(data, pos)
+        elif ex_id == 25:
+            engine_type, engine_id = struct.unpack_from('<BB', data, pos + 2)
+            flow[45] = '%d/%d' %(engine_type, engine_id)
+        elif ex_id == 27:
+            flow[47] = self.time(struct.unpack_from('<Q', data, pos)[0] // 1000)
+
+    def v3Record(self, data, pos, size):
+        """Decodes a V3 record (nfdump 1.7) into a flow.
+        """
+        rtype, size, elements, engine_type, engine_id, exporter, flags, version = V3_HEADER.unpack_from(data, pos)
+        flow = list(self.default)
+        flow[45] = '%d/%d' %(engine_type, engine_id)
+        flow[46] = exporter
+
+        end = pos + size
+        pos += V3_HEADER.size
+        while pos + RECORD_HEADER.size <= end:
+            etype, length = RECORD_HEADER.unpack_from(data, pos)
+            if length < RECORD_HEADER.size or pos + length > end:
+                break
+            self.element(flow, etype, data, pos + RECORD_HEADER.size)
+            pos += length
+
+        return tuple(flow)
+
+    def element(self, flow, etype, data, pos):
+        """Fills the fields of a flow from an element of a V3 record.
+        """
+        if etype == 1:          # generic flow
+            first, last, received, packets, nbytes, srcport, dstport, prot, tcp_flags, fwd_status, tos = \
+                GENERIC_FLOW.unpack_from(data, pos)
+            self.common(flow, first // 1000, first % 1000, last // 1000, last % 1000,
+                        fwd_status, tcp_flags, prot, tos, srcport, dstport)
+            flow[11], flow[12] = packets, nbytes
+            flow[47] = self.time(received // 1000)
+        elif etype == 2:        # IPv4 addresses
+            src, dst = struct.unpack_from('<II', data, pos)
+            flow[3], flow[4] = self.ip(src), self.ip(dst)
+        elif etype == 3:        # IPv6 addresses
+            flow[3], flow[4] = self.ip6(data, pos), self.ip6(data, pos + 16)
+        elif etype == 4:        # interfaces, masks, direction and destination tos
+            flow[15], flow[16], flow[19], flow[20], flow[22], flow[21] = struct.unpack_from('<IIBBBB', data, pos)
+        elif etype == 5:        # output counters
+            flow[13], flow[14] = struct.unpack_from('<QQ', data, pos + 8)
+        elif etype == 6:        # vlans
+            flow[25], flow[26] = struct.unpack_from('<II', data, pos)
+        elif etype == 7:        # AS numbers
+            flow[17], flow[18] = struct.unpack_from('<II', data, pos)
+        elif etype == 8 or etype == 10:         # next hops (BGP and IP)
+            flow[24 if etype == 8 else 23] = self.ip(struct.unpack_from('<I', data, pos)[0])
+        elif etype == 9 or etype == 11:
+            flow[24 if etype == 9 else 23] = self.ip6(data, pos)
+        elif etype == 12:       # exporter address
+            flow[44] = self.ip(struct.unpack_from('<I', data, pos)[0])
+        elif etype == 13:
+            flow[44] = self.ip6(data, pos)
+        elif etype == 14:       # MPLS labels
+            for i, label in enumerate(struct.unpack_from('<10I', data, pos)):
+                flow[31 + i] = mpls(label)
+        elif etype == 15:       # MAC addresses
+            in_src, out_dst, in_dst, out_src = struct.unpack_from('<QQQQ', data, pos)
+            flow[27], flow[28], flow[29], flow[30] = mac(in_src), mac(out_dst), mac(in_dst), mac(out_src)
+
+
+def icmpPort(port):
+    '''
+    Destination port of ICMP flows, printed by nfdump as type.code.
+    '''
+    value = float('%d.%d' %(port >> 8, port & 0xff))
+    return int(value) if value.is_integer() else value
+
+
+def tcpFlags(flags):
+    '''
+    TCP flags, printed by nfdump as a string (eg. '.A..S.').
+    '''
+    if flags > 63:
+        return '0x%2x' %(flags)
+    return ''.join(c if flags & (32 >> i) else '.' for i, c in enumerate('UAPRSF'))
+
+
+TCP_FLAGS = tuple(tcpFlags(flags) for flags in range(256))
+PROTOCOL_NAMES = tuple(PROTOCOLS.get(prot, str(prot)) for prot in range(256))
+
+
+def mac(value):
+    '''
+    MAC address stored as an integer, printed by nfdump as a string (eg. '00:1b:21:3c:9d:f8').
+    '''
+    return ':'.join('%.2x' %((value >> (8*i)) & 0xff) for i in range(5, -1, -1))
+
+
+def mpls(label):
+    '''
+    MPLS label, printed by nfdump as label-exp-bottom of stack.
+    '''
+    return '%d-%d-%d' %(label >> 4, (label & 0xf) >> 1, label & 1)
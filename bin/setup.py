@@ -9,6 +9,6 @@ setup(name='fcparser',
       license='GPLv3',
       packages=['fcparser','deparser'],
       install_requires=[
-          'IPy', 'pyyaml'
+          'IPy', 'pyyaml', 'numpy'
       ],
       zip_safe=False)
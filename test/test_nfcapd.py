@@ -0,0 +1,191 @@
+"""
+test_nfcapd -- Checks of the native reader of nfcapd files (bin/nfcapd.py).
+
+The example capture shipped with the repository (nfdump 1.6 layout) is decoded
+as is, and rewritten with compressed data blocks. A small nfdump 1.7 file with
+V3 records is built in place. Compressions whose package is not installed are
+skipped.
+
+Run with: python -m pytest test/  (or python -m unittest discover test)
+
+"""
+
+import bz2
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import nfcapd
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'Examples_data', 'nfcapd.201612021832')
+
+# Compressors of the data blocks, by compression name (None if the package is not installed)
+COMPRESSORS = {'bz2': bz2.compress}
+try:
+    import lzo
+    COMPRESSORS['lzo'] = lambda data: lzo.compress(data, 1, False)
+except ImportError:
+    COMPRESSORS['lzo'] = None
+try:
+    import lz4.block
+    COMPRESSORS['lz4'] = lambda data: lz4.block.compress(data, store_size=False)
+except ImportError:
+    COMPRESSORS['lz4'] = None
+try:
+    import zstandard
+    COMPRESSORS['zstd'] = lambda data: zstandard.ZstdCompressor().compress(data)
+except ImportError:
+    COMPRESSORS['zstd'] = None
+
+FLAGS_V1 = {'lzo': nfcapd.FLAG_LZO, 'bz2': nfcapd.FLAG_BZ2, 'lz4': nfcapd.FLAG_LZ4, 'zstd': nfcapd.FLAG_ZSTD}
+CODES_V2 = {name: code for code, name in nfcapd.COMPRESSION_V2.items()}
+
+
+def splitBlocks(data, offset):
+    '''
+    Returns the data blocks of the contents of a nfcapd file, from offset, as tuples (header, data).
+    '''
+    blocks = list()
+    while offset + nfcapd.BLOCK_HEADER.size <= len(data):
+        records, size, btype, flags = nfcapd.BLOCK_HEADER.unpack_from(data, offset)
+        start = offset + nfcapd.BLOCK_HEADER.size
+        blocks.append(((records, size, btype, flags), data[start:start + size]))
+        offset = start + size
+    return blocks
+
+
+def joinBlocks(blocks, compress=None):
+    '''
+    Returns the data blocks given as tuples (header, data) as bytes, compressing their data.
+    '''
+    output = b''
+    for (records, size, btype, flags), data in blocks:
+        if compress is not None:
+            data = compress(data)
+        output += nfcapd.BLOCK_HEADER.pack(records, len(data), btype, flags) + data
+    return output
+
+
+def recompressV1(fname, compression):
+    '''
+    Rewrites a nfcapd file of layout 1 with its data blocks compressed. Returns the new file name.
+    '''
+    with open(EXAMPLE, 'rb') as f:
+        data = f.read()
+    layout, current, offset, end = nfcapd.readHeader(EXAMPLE)
+    header = bytearray(data[:offset])
+    flags = struct.unpack_from('<I', header, 4)[0] | FLAGS_V1[compression]
+    struct.pack_into('<I', header, 4, flags)
+    with open(fname, 'wb') as f:
+        f.write(bytes(header) + joinBlocks(splitBlocks(data, offset), COMPRESSORS[compression]))
+    return fname
+
+
+def v3File(fname, flows, compression=None):
+    '''
+    Writes a nfcapd file of layout 2 (nfdump 1.7) with a data block of V3 records. Flows are given
+    as tuples (first msec, last msec, packets, bytes, srcport, dstport, protocol, tcp flags, src, dst)
+    with IPv4 addresses as integers. Returns the file name.
+    '''
+    records = b''
+    for first, last, packets, nbytes, srcport, dstport, prot, tcp_flags, src, dst in flows:
+        generic = nfcapd.GENERIC_FLOW.pack(first, last, last, packets, nbytes, srcport, dstport, prot, tcp_flags, 0, 0)
+        addresses = struct.pack('<II', src, dst)
+        elements = nfcapd.RECORD_HEADER.pack(1, 4 + len(generic)) + generic + \
+                   nfcapd.RECORD_HEADER.pack(2, 4 + len(addresses)) + addresses
+        size = nfcapd.V3_HEADER.size + len(elements)
+        records += nfcapd.V3_HEADER.pack(nfcapd.V3_RECORD, size, 2, 1, 2, 3, 0, 0) + elements
+
+    block = ((len(flows), len(records), 3, 0), records)
+    header = nfcapd.FILE_HEADER_V2.pack(nfcapd.MAGIC, nfcapd.LAYOUT_VERSION_2, 0, 0,
+                                        CODES_V2[compression], 0, 0, 0, 0, 0, 1)
+    compress = COMPRESSORS[compression] if compression else None
+    with open(fname, 'wb') as f:
+        f.write(header + joinBlocks([block], compress))
+    return fname
+
+
+class ExampleFileTest(unittest.TestCase):
+    """Decoding of the example capture (layout 1, uncompressed) and of copies with compressed blocks.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.flows = list(nfcapd.readFlows(EXAMPLE))
+
+    def test_flows(self):
+        self.assertEqual(nfcapd.readHeader(EXAMPLE)[:2], (nfcapd.LAYOUT_VERSION_1, None))
+        self.assertEqual(len(self.flows), 83)
+        self.assertEqual(sum(flow[nfcapd.FIELD['ipkt']] for flow in self.flows), 513783)
+        self.assertEqual(sum(flow[nfcapd.FIELD['ibyt']] for flow in self.flows), 769412624)
+
+        first = self.flows[0]
+        self.assertEqual(len(first), len(nfcapd.CSV_FIELDS))
+        self.assertEqual([str(first[nfcapd.FIELD[name]]) for name in ('sa', 'da', 'sp', 'dp', 'pr', 'ipkt', 'ibyt', 'in')],
+                         ['192.168.1.2', '192.168.1.11', '49641', '161', 'UDP', '2', '174', '3'])
+        self.assertAlmostEqual(first[nfcapd.FIELD['td']], 60.01)
+
+    def check_compression(self, compression):
+        if COMPRESSORS[compression] is None or nfcapd.decompressor(compression) is None:
+            self.skipTest("package for %s compression not installed" %(compression))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = recompressV1(os.path.join(tmp, 'nfcapd.' + compression), compression)
+            self.assertEqual(nfcapd.readHeader(fname)[1], compression)
+            self.assertTrue(nfcapd.supported(fname))
+            self.assertEqual(list(nfcapd.readFlows(fname)), self.flows)
+
+    def test_bz2(self):
+        self.check_compression('bz2')
+
+    def test_lzo(self):
+        self.check_compression('lzo')
+
+    def test_lz4(self):
+        self.check_compression('lz4')
+
+    def test_zstd(self):
+        self.check_compression('zstd')
+
+
+class V3RecordTest(unittest.TestCase):
+    """Decoding of V3 records of layout 2 files (nfdump 1.7).
+    """
+    FLOWS = [(1480703400123, 1480703460456, 10, 1500, 51000, 443, 6, 0x12, 0xC0A80102, 0x08080808),
+             (1480703401000, 1480703401000, 1, 64, 0, 0x0303, 1, 0, 0x0A000001, 0x0A000002)]
+
+    def check(self, compression):
+        if compression and (COMPRESSORS[compression] is None or nfcapd.decompressor(compression) is None):
+            self.skipTest("package for %s compression not installed" %(compression))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = v3File(os.path.join(tmp, 'nfcapd.v3'), self.FLOWS, compression)
+            self.assertEqual(nfcapd.readHeader(fname)[:2], (nfcapd.LAYOUT_VERSION_2, compression))
+            flows = list(nfcapd.readFlows(fname))
+
+        self.assertEqual(len(flows), 2)
+        tcp, icmp = flows
+        self.assertEqual(tcp[nfcapd.FIELD['ts']], datetime.fromtimestamp(1480703400))
+        self.assertEqual(tcp[nfcapd.FIELD['te']], datetime.fromtimestamp(1480703460))
+        self.assertAlmostEqual(tcp[nfcapd.FIELD['td']], 60.333)
+        self.assertEqual([str(tcp[nfcapd.FIELD[name]]) for name in ('sa', 'da', 'sp', 'dp', 'pr', 'flg', 'ipkt', 'ibyt', 'eng', 'exid')],
+                         ['192.168.1.2', '8.8.8.8', '51000', '443', 'TCP', '.A..S.', '10', '1500', '1/2', '3'])
+        self.assertEqual([str(icmp[nfcapd.FIELD[name]]) for name in ('sa', 'da', 'dp', 'pr')],
+                         ['10.0.0.1', '10.0.0.2', '3.3', 'ICMP'])
+
+    def test_uncompressed(self):
+        self.check(None)
+
+    def test_bz2(self):
+        self.check('bz2')
+
+    def test_lz4(self):
+        self.check('lz4')
+
+    def test_zstd(self):
+        self.check('zstd')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+test_nfdump -- Checks of the conversion of nfcapd files through a nfdump pipe (faac.nfdumpRecords).
+
+A stub nfdump script, put first in the PATH, stands in for the binary: it writes the contents of
+the file given with -r, as if they were the csv output of nfdump, and exits with the status given
+in the environment variable NFDUMP_STUB_STATUS (0 by default).
+
+Run with: python -m pytest test/  (or python -m unittest discover test)
+
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import faac
+import fcparser
+
+STUB = """#!%s
+import os, sys
+with open(sys.argv[sys.argv.index('-r') + 1], 'rb') as f:
+    sys.stdout.buffer.write(f.read())
+sys.stdout.flush()
+sys.exit(int(os.environ.get('NFDUMP_STUB_STATUS', '0')))
+""" %(sys.executable)
+
+HEADER = 'ts,te,td,sa,da,sp,dp,pr,flg,fwd,stos,ipkt,ibyt,opkt,obyt,in,out,sas,das,smk,dmk,dtos,dir,nh,nhb,svln,dvln,ismc,odmc,idmc,osmc,mpls1,mpls2,mpls3,mpls4,mpls5,mpls6,mpls7,mpls8,mpls9,mpls10,cl,sl,al,ra,eng,exid,tr'
+SUMMARY = ['Summary', 'flows,bytes,packets,avg_bps,avg_pps,avg_bpp', '2,3000,20,400,2,150']
+FLOWS = ['2016-12-02 18:32:01,2016-12-02 18:33:01,60.000,192.168.1.2,192.168.1.11,49641,161,UDP,......,0,0,2,174',
+         '2016-12-02 18:32:05,2016-12-02 18:32:06,1.000,10.0.0.1,10.0.0.2,51000,443,TCP,.A..S.,0,0,18,2826']
+
+
+class NfdumpStubTest(unittest.TestCase):
+    """Conversion of the csv output of the stub nfdump.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        stub = os.path.join(self.tmp.name, faac.NFDUMP)
+        with open(stub, 'w') as f:
+            f.write(STUB)
+        os.chmod(stub, 0o755)
+        environ = mock.patch.dict(os.environ, {'PATH': self.tmp.name + os.pathsep + os.environ.get('PATH', '')})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+        # The nfdump processes are recorded to check that they are reaped
+        self.processes = []
+        popen = faac.subprocess.Popen
+        def record(*args, **kwargs):
+            process = popen(*args, **kwargs)
+            self.processes.append(process)
+            return process
+        patch = mock.patch.object(faac.subprocess, 'Popen', side_effect=record)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def capture(self, lines):
+        '''
+        Writes a fake nfcapd file with the given lines, as the stub nfdump will output them. Returns its path.
+        '''
+        fname = os.path.join(self.tmp.name, 'nfcapd.201612021830')
+        with open(fname, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return fname
+
+    def assertReaped(self):
+        self.assertEqual(len(self.processes), 1)
+        self.assertIsNotNone(self.processes[0].returncode)
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(self.processes[0].pid, os.WNOHANG)
+
+    def test_header_and_summary_dropped(self):
+        fname = self.capture([HEADER] + FLOWS + SUMMARY)
+        self.assertEqual(list(faac.nfdumpRecords(fname)), [flow.encode() for flow in FLOWS])
+        self.assertEqual(self.processes[0].args, [faac.NFDUMP, '-r', fname, '-o', 'csv'])
+        self.assertReaped()
+
+    def test_shorter_than_summary(self):
+        fname = self.capture([HEADER] + SUMMARY[:faac.NFDUMP_SUMMARY - 1])
+        self.assertEqual(list(faac.nfdumpRecords(fname)), [])
+        self.assertReaped()
+
+    def test_failure(self):
+        fname = self.capture([HEADER] + FLOWS + SUMMARY)
+        output = io.StringIO()
+        with mock.patch.dict(os.environ, {'NFDUMP_STUB_STATUS': '2'}), redirect_stdout(output):
+            records = list(faac.nfdumpRecords(fname))
+        self.assertEqual(records, [flow.encode() for flow in FLOWS])
+        self.assertIn("nfdump failed converting '%s' (exit status 2)" %(fname), output.getvalue())
+        self.assertReaped()
+
+    def test_closed_early(self):
+        fname = self.capture([HEADER] + FLOWS * 100000 + SUMMARY)       # more than the pipe buffer
+        records = faac.nfdumpRecords(fname)
+        self.assertEqual(next(records), FLOWS[0].encode())
+        records.close()
+        self.assertReaped()
+
+    def test_parser_fallback(self):
+        # The fake file is not a nfcapd file that the native reader supports, so the parser uses nfdump
+        fname = self.capture([HEADER] + FLOWS + SUMMARY)
+        self.assertEqual(list(fcparser.nfcapdRecords(fname)), [flow.encode() for flow in FLOWS])
+        self.assertReaped()
+
+
+if __name__ == "__main__":
+    unittest.main()